@@ -0,0 +1,282 @@
+import asyncio
+import threading
+from urllib.parse import urljoin
+import json_backend
+import metrics
+import rate_limit
+from geoserver import WriteResult, DEFAULT_UPLOAD_WORKERS
+from http_cache import DEFAULT_TIMEOUT
+
+# httpx is only needed for the async mode, h2 for HTTP/2 (pip install httpx[http2])
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_CONNECTIONS = 64
+
+def _client(headers=None, auth=None, timeout=DEFAULT_TIMEOUT, http2=False, connections=DEFAULT_CONNECTIONS):
+    if httpx is None:
+        raise RuntimeError("The async mode needs httpx, install it with pip install httpx (or httpx[http2] for --http2)")
+    return httpx.AsyncClient(
+        headers=headers,
+        auth=auth,
+        timeout=timeout,
+        http2=http2,
+        limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        follow_redirects=True
+    )
+
+class EventLoopThread:
+
+    """
+    An asyncio event loop running in a daemon thread. Coroutines are handed to it from other threads with submit.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine):
+        """
+        Schedules coroutine on the loop and returns a concurrent.futures.Future of its result.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """
+        Runs coroutine on the loop and waits for its result.
+        """
+
+        return self.submit(coroutine).result()
+
+    def is_current(self):
+        """
+        True when called from the loop thread, where waiting on the loop would deadlock.
+        """
+
+        return threading.current_thread() is self._thread
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+class AsyncFetcher:
+
+    """
+    Async counterpart of http_cache.CachedHttpClient for the FMI catalog: many JSON requests multiplexed over
+    the keep-alive connections of one httpx.AsyncClient. Uses the same HttpCache and conditional requests.
+    Must be used from a single event loop.
+
+    cache - Optional HttpCache. Without a cache every request downloads the full body
+    headers - Headers sent with every request
+    http2 - Use HTTP/2 where the server supports it, needs the h2 package
+    connections - Maximum number of open connections
+    """
+
+    def __init__(self, cache=None, headers=None, timeout=DEFAULT_TIMEOUT, http2=False, connections=DEFAULT_CONNECTIONS):
+        self.cache = cache
+        self.client = _client(headers, timeout=timeout, http2=http2, connections=connections)
+        self.stats = {"requests": 0, "not_modified": 0, "bytes_downloaded": 0, "bytes_from_cache": 0}
+
+    @classmethod
+    def from_client(cls, client, http2=False, connections=DEFAULT_CONNECTIONS):
+        """
+        Returns an AsyncFetcher with the cache, headers and timeout of a CachedHttpClient, or the defaults if client is None.
+        """
+
+        if client is None:
+            return cls(http2=http2, connections=connections)
+        return cls(client.cache, client.headers, client.timeout, http2=http2, connections=connections)
+
+    def _count(self, **counts):
+        # All coroutines run on one thread, the statistics need no lock
+        for key, value in counts.items():
+            self.stats[key] += value
+            metrics.count(key, value, stage="fmi")
+
+    async def get_bytes(self, url):
+        """
+        Returns the body of url, revalidating a cached copy with a conditional request when there is one.
+        """
+
+        cached = self.cache.get(url) if self.cache else None
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        async with rate_limit.slot_async(url):
+            r = await self.client.get(url, headers=headers)
+            if r.status_code != 304 or not cached:
+                r.raise_for_status()
+
+        if r.status_code == 304 and cached:
+            self._count(requests=1, not_modified=1, bytes_from_cache=len(cached[2]))
+            return cached[2]
+
+        body = r.content
+        self._count(requests=1, bytes_downloaded=len(body))
+
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if self.cache and (etag or last_modified):
+            self.cache.put(url, etag, last_modified, body)
+        return body
+
+    async def get_json(self, url):
+        return json_backend.loads(await self.get_bytes(url))
+
+    async def close(self):
+        await self.client.aclose()
+
+class AsyncGeoServerWriter:
+
+    """
+    Writer for the GeoServer OSEO REST API with the interface of geoserver.GeoServerWriter, whose writes are
+    coroutines on an event loop thread sharing one httpx.AsyncClient. Can be called from any thread: the product
+    writes return concurrent.futures.Futures of their WriteResults. At most 2 * workers writes are queued, as with
+    GeoServerWriter: other threads block in submit, coroutines on the loop await ready before they submit.
+
+    app_host - The REST API path, e.g. <host>/geoserver/rest/oseo/
+    auth - (user, password) tuple for the REST API
+    headers - Headers sent with every request
+    workers - Number of product writes in flight at the same time
+    on_result - Optional function called with every WriteResult as the writes complete
+    retrier - Optional Retrier for the requests
+    http2 - Use HTTP/2 where the server supports it, needs the h2 package
+    loop_thread - EventLoopThread the writes run on, a new one if not given
+    timeout - Seconds to wait for GeoServer to connect or to answer, see GeoServerWriter
+    """
+
+    def __init__(self, app_host, auth, headers=None, workers=DEFAULT_UPLOAD_WORKERS, on_result=None, retrier=None, http2=False, loop_thread=None, timeout=DEFAULT_TIMEOUT):
+        self.app_host = app_host
+        self.workers = max(1, int(workers))
+        self.on_result = on_result
+        self.retrier = retrier
+        self._own_loop = loop_thread is None
+        self.loop_thread = loop_thread or EventLoopThread()
+        self.client = _client(headers, auth=auth, timeout=timeout, http2=http2, connections=self.workers)
+
+        # Created on the loop, as they belong to it. _queued is only changed on the loop
+        self._in_flight, self._released = self.loop_thread.run(self._primitives())
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._results = []
+        self._pending = []
+
+    async def _primitives(self):
+        return asyncio.Semaphore(self.workers), asyncio.Condition()
+
+    async def ready(self):
+        """
+        Waits until another write may be queued. Must be awaited on the loop right before a product write is submitted.
+        """
+
+        async with self._released:
+            await self._released.wait_for(lambda: self._queued < self.workers * 2)
+
+    async def _reserve(self):
+        await self.ready()
+        self._queued += 1
+
+    async def _send(self, method, url, json=None, key=None):
+        body = json_backend.dumps(json) if json is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else None
+
+        async def send():
+            metrics.count("requests", stage="geoserver")
+            if body is not None:
+                metrics.count("bytes_uploaded", len(body), stage="geoserver")
+            async with rate_limit.slot_async(url):
+                r = await self.client.request(method, url, content=body, headers=headers)
+                r.raise_for_status()
+            return r
+
+        with metrics.timer("upload"):
+            if self.retrier:
+                return await self.retrier.call_async("upload", key or url, send)
+            return await send()
+
+    def request(self, method, request_point, json=None):
+        """
+        Sends a single request and waits for it. Raises for error responses, used for the collection level writes.
+        """
+
+        return self.loop_thread.run(self._send(method, urljoin(self.app_host, request_point), json=json))
+
+    async def _write(self, key, method, url, json):
+        try:
+            async with self._in_flight:
+                r = await self._send(method, url, json=json, key=key)
+            result = WriteResult(key, method, url, r.status_code, None)
+        except httpx.HTTPStatusError as e:
+            result = WriteResult(key, method, url, e.response.status_code, f"{e}: {e.response.text[:500]}")
+        except Exception as e:
+            result = WriteResult(key, method, url, None, str(e))
+        finally:
+            async with self._released:
+                self._queued -= 1
+                self._released.notify_all()
+
+        with self._lock:
+            self._results.append(result)
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def submit(self, method, request_point, json=None, key=None):
+        """
+        Queues a write and returns a Future of the WriteResult. Called from another thread, blocks while the maximum
+        number of writes is already queued. Called on the loop, the caller must have awaited ready.
+        """
+
+        if self.loop_thread.is_current():
+            self._queued += 1
+        else:
+            self.loop_thread.run(self._reserve())
+        future = self.loop_thread.submit(self._write(key, method, urljoin(self.app_host, request_point), json))
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def post_product(self, collection_id, product, key=None):
+        return self.submit("POST", f"collections/{collection_id}/products", json=product, key=key)
+
+    def put_product(self, collection_id, product_id, product, key=None):
+        return self.submit("PUT", f"collections/{collection_id}/products/{product_id}", json=product, key=key)
+
+    def delete_product(self, collection_id, product_id, key=None):
+        return self.submit("DELETE", f"collections/{collection_id}/products/{product_id}", key=key)
+
+    def drain(self):
+        """
+        Waits for all queued writes and returns their WriteResults, see GeoServerWriter.drain.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        self.drain()
+        self.loop_thread.run(self.client.aclose())
+        if self._own_loop:
+            self.loop_thread.close()
+
+def item_links(collection_dict, href):
+    """
+    Returns the absolute hrefs of the item links of a raw collection dictionary loaded from href.
+    """
+
+    return [urljoin(href, link["href"]) for link in collection_dict.get("links", []) if link.get("rel") == "item"]
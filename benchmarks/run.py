@@ -0,0 +1,215 @@
+import argparse
+import contextlib
+import copy
+import getpass
+import json
+import os
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from servers import StaticCatalogServer, MockGeoServer
+from synthetic_catalog import generate_catalog, collection_name
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+BENCHMARKS = [
+    "create_fmi_collections",
+    "update_catalog_cold",
+    "update_catalog_warm",
+    "fmi_to_geoserver_cold",
+    "fmi_to_geoserver_warm",
+]
+
+def _fmi_client(cache_dir, no_cache):
+    import http_cache
+    fmi_client = http_cache.CachedHttpClient(None if no_cache else http_cache.HttpCache(cache_dir / "http.sqlite"))
+    http_cache.install(fmi_client)
+    return fmi_client
+
+def _raster_cache(cache_dir, no_cache):
+    from raster_metadata import RasterMetadataCache
+    return None if no_cache else RasterMetadataCache(cache_dir / "raster_metadata.sqlite")
+
+def run_create_fmi_collections(config, work_dir):
+    import fmi_to_stac
+
+    # The synthetic collections take the place of the FMI collections, with the metadata of the first real one
+    template = next(iter(fmi_to_stac.collection_info.values()))
+    fmi_to_stac.fmi_collections = config["collection_urls"]
+    for index, url in enumerate(config["collection_urls"]):
+        name = collection_name(index)
+        fmi_to_stac.news_ids[name] = f"{name}_at_fmi"
+        fmi_to_stac.collection_info[f"{name}_at_fmi"] = {**copy.copy(template), "title": name, "original_href": url}
+
+    cache_dir = work_dir / "cache_stac"
+    os.chdir(work_dir)
+    fmi_to_stac.create_fmi_collections(
+        workers=config["workers"],
+        raster_cache=_raster_cache(cache_dir, config["no_cache"]),
+        processes=config["processes"],
+        fmi_client=_fmi_client(cache_dir, config["no_cache"])
+    )
+
+def run_update_catalog(config, work_dir):
+    import pystac_client
+    import update_fmi
+
+    update_fmi.pwd = "benchmark"
+    cache_dir = work_dir / "cache_update"
+    update_fmi.update_catalog(
+        f"{config['geoserver']}/geoserver/rest/oseo/",
+        pystac_client.Client.open(f"{config['geoserver']}/geoserver/ogc/stac/v1/"),
+        cache_dir / "sync",
+        workers=config["workers"],
+        raster_cache=_raster_cache(cache_dir, config["no_cache"]),
+        upload_workers=config["workers"],
+        probe_workers=config["workers"],
+        processes=config["processes"],
+        fmi_client=_fmi_client(cache_dir, config["no_cache"]),
+        use_async=config["use_async"]
+    )
+
+def run_fmi_to_geoserver(config, work_dir):
+    getpass.getpass = lambda *args, **kwargs: "benchmark"
+    sys.argv = [
+        "fmi_to_geoserver.py",
+        "--host", config["geoserver"],
+        "--catalog-dir", str(work_dir / "FMI"),
+        "--cache-dir", str(work_dir / "cache_upload"),
+        "--upload-workers", str(config["workers"]),
+    ]
+    runpy.run_path(str(REPO_DIR / "fmi_to_geoserver.py"), run_name="__main__")
+
+RUNNERS = {
+    "create_fmi_collections": run_create_fmi_collections,
+    "update_catalog_cold": run_update_catalog,
+    "update_catalog_warm": run_update_catalog,
+    "fmi_to_geoserver_cold": run_fmi_to_geoserver,
+    "fmi_to_geoserver_warm": run_fmi_to_geoserver,
+}
+
+def run_child(name, config_file, result_file):
+    """
+    Runs one benchmark in this process and writes its time, peak memory and stage metrics into result_file.
+    Each benchmark has a process of its own, so that the peak RSS is its own and the module level state starts clean.
+    """
+
+    sys.path.insert(0, str(REPO_DIR))
+    with open(config_file) as f:
+        config = json.load(f)
+
+    output = sys.stdout if config["verbose"] else open(os.devnull, "w")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        RUNNERS[name](config, Path(config["work_dir"]))
+    elapsed = time.perf_counter() - start
+
+    import metrics
+
+    # ru_maxrss is in kilobytes on Linux, the worker processes are counted separately
+    with open(result_file, "w") as f:
+        json.dump({
+            "seconds": elapsed,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_rss_workers_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "stages": metrics.METRICS.report()["stages"],
+        }, f)
+
+def run_benchmarks(args):
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="fmi_bench_")).resolve()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+
+    fmi = StaticCatalogServer(work_dir / "fmi", latency=args.latency / 1000)
+    print(f"Writing a catalog of {args.collections} collections x {args.children} sub-collections x {args.items} items")
+    collection_urls = generate_catalog(work_dir / "fmi", fmi.url, args.collections, args.children, args.items, args.raster_size)
+    geoserver = MockGeoServer(
+        {f"{collection_name(index)}_at_fmi": url for index, url in enumerate(collection_urls)},
+        latency=args.latency / 1000
+    )
+
+    config = {
+        "work_dir": str(work_dir),
+        "collection_urls": collection_urls,
+        "geoserver": geoserver.url,
+        "workers": args.workers,
+        "processes": args.processes,
+        "no_cache": args.no_cache,
+        "use_async": args.use_async,
+        "verbose": args.verbose,
+    }
+    config_file = work_dir / "config.json"
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+
+    item_count = args.collections * args.children * args.items
+    results = []
+    for name in args.benchmarks:
+        # Cold runs start from an empty GeoServer and without the upload state of the previous runs
+        if name.endswith("_cold"):
+            geoserver.reset()
+            shutil.rmtree(work_dir / ("cache_update" if name.startswith("update") else "cache_upload"), ignore_errors=True)
+        fmi.take_counts()
+        geoserver.take_counts()
+
+        result_file = work_dir / f"{name}.json"
+        subprocess.run([sys.executable, __file__, "--run", name, "--config", str(config_file), "--result", str(result_file)], check=True)
+        with open(result_file) as f:
+            result = json.load(f)
+
+        result.update({
+            "benchmark": name,
+            "items": item_count,
+            "items_per_second": item_count / result["seconds"],
+            "requests": {**fmi.take_counts(), **geoserver.take_counts()},
+            "products": len(geoserver.products),
+        })
+        results.append(result)
+        print(
+            f"{name:<24} {result['seconds']:8.2f} s {result['items_per_second']:9.1f} items/s "
+            f"{result['peak_rss_mb']:8.1f} MB (workers {result['peak_rss_workers_mb']:.1f} MB)  "
+            + ", ".join(f"{stage} {count}" for stage, count in sorted(result["requests"].items()))
+        )
+
+    fmi.close()
+    geoserver.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": {key: value for key, value in vars(args).items() if key not in ("run", "config", "result")}, "results": results}, f, indent=2, default=str)
+        print(f"Results written to {args.output}")
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks of the scripts against a local synthetic FMI catalog and a mock GeoServer")
+    parser.add_argument("--collections", type=int, default=2, help="Number of collections in the synthetic catalog")
+    parser.add_argument("--children", type=int, default=4, help="Number of sub-collections per collection")
+    parser.add_argument("--items", type=int, default=50, help="Number of items per sub-collection")
+    parser.add_argument("--raster-size", type=int, default=256, help="Width and height of the COG assets in pixels")
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds added to every response of the servers")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent requests, raster reads and writes given to the scripts")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes given to the scripts")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Run update_catalog in its asyncio mode")
+    parser.add_argument("--no-cache", action="store_true", help="Run the scripts without their local caches")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run, in this order")
+    parser.add_argument("--output", type=Path, default=None, help="JSON file for the results")
+    parser.add_argument("--work-dir", type=Path, default=None, help="Directory of the catalog and the outputs, a temporary directory if not given")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory after the run")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the scripts")
+    parser.add_argument("--run", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument("--config", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--result", type=Path, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run:
+        run_child(args.run, args.config, args.result)
+    else:
+        run_benchmarks(args)
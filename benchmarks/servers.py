@@ -0,0 +1,256 @@
+import json
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from synthetic_catalog import RASTER_FILE
+
+class _Server:
+
+    """
+    Base of the local servers: a threaded HTTP server in a daemon thread with a fixed latency added to every
+    response and a counter of the requests per stage.
+
+    latency - Seconds waited before every response
+    """
+
+    def __init__(self, handler, latency=0.0):
+        self.latency = latency
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def count(self, stage):
+        with self._lock:
+            self.counts[stage] += 1
+
+    def take_counts(self):
+        """
+        Returns the request counts since the last call and resets them.
+        """
+
+        with self._lock:
+            counts, self.counts = dict(self.counts), Counter()
+        return counts
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def owner(self):
+        return self.server.owner
+
+    def send_body(self, status, body=b"", headers=None, content_type="application/json"):
+        time.sleep(self.owner.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, status, content=None):
+        self.send_body(status, json.dumps(content).encode("utf-8") if content is not None else b"")
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body) if body else None
+
+class _StaticHandler(_Handler):
+
+    def _file(self):
+        path = urlparse(self.path).path.lstrip("/")
+        # Every asset URL is served from the same COG
+        if path.startswith("assets/"):
+            return self.owner.root / RASTER_FILE, "raster"
+        if "/items/" in path:
+            return self.owner.root / path, "item"
+        return self.owner.root / path, "collection"
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path, stage = self._file()
+        self.owner.count(f"fmi_{stage}_{self.command.lower()}")
+        if not path.is_file():
+            return self.send_json(404, {})
+
+        stat = path.stat()
+        headers = {
+            "ETag": f'"{stat.st_size}-{stat.st_mtime_ns}"',
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+        }
+        content_type = "image/tiff" if stage == "raster" else "application/json"
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            self.owner.count("fmi_not_modified")
+            return self.send_body(304, headers=headers, content_type=content_type)
+
+        with open(path, "rb") as f:
+            body = f.read()
+
+        # Single byte ranges, which is what GDAL asks for when it reads a COG header
+        byte_range = self.headers.get("Range")
+        if byte_range and byte_range.startswith("bytes=") and "," not in byte_range:
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start = int(start)
+            end = min(int(end) if end else len(body) - 1, len(body) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            return self.send_body(206, body[start:end + 1], headers, content_type)
+
+        self.send_body(200, body, headers, content_type)
+
+class StaticCatalogServer(_Server):
+
+    """
+    Serves a synthetic FMI catalog from a directory with ETag/Last-Modified validators, conditional requests and byte ranges.
+    Requests are counted per stage: collection (collections and sub-collections), item and raster,
+    and the conditional requests answered with 304 Not Modified as not_modified.
+
+    root - Directory of the catalog, see synthetic_catalog.generate_catalog
+    latency - Seconds waited before every response
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = Path(root)
+        super().__init__(_StaticHandler, latency)
+
+class _ApiHandler(_Handler):
+
+    def _collection(self, collection_id):
+        api = f"{self.owner.url}/geoserver/ogc/stac/v1"
+        collection = {
+            "type": "Collection",
+            "stac_version": "1.0.0",
+            "id": collection_id,
+            "title": collection_id,
+            "description": f"Mirror of {collection_id}",
+            "license": "CC-BY-4.0",
+            "providers": [{"name": "FMI"}],
+            "summaries": {"gsd": [10]},
+            "extent": {"spatial": {"bbox": [[19.0, 59.0, 32.0, 71.0]]}, "temporal": {"interval": [[None, None]]}},
+            "links": [
+                {"rel": "self", "href": f"{api}/collections/{collection_id}"},
+                {"rel": "root", "href": f"{api}/"},
+            ]
+        }
+        derived_from = self.owner.collections.get(collection_id)
+        if derived_from:
+            collection["links"].append({"rel": "derived_from", "href": derived_from})
+        return collection
+
+    def _search(self, query):
+        api = f"{self.owner.url}/geoserver/ogc/stac/v1"
+        collections = set(query.get("collections") or self.owner.collections)
+        limit = int(query.get("limit") or 100)
+        offset = int(query.get("token") or 0)
+        with self.owner.lock:
+            ids = sorted(
+                product_id for product_id, product in self.owner.products.items()
+                if product["properties"].get("eop:parentIdentifier") in collections
+            )
+        page = ids[offset:offset + limit]
+        links = []
+        if offset + limit < len(ids):
+            links.append({"rel": "next", "href": f"{api}/search", "method": "POST", "body": {**query, "token": offset + limit}, "merge": False})
+        return {"type": "FeatureCollection", "features": [{"type": "Feature", "id": product_id, "properties": {}} for product_id in page], "links": links}
+
+    def do_GET(self):
+        api = f"{self.owner.url}/geoserver/ogc/stac/v1"
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        self.owner.count("stac_api")
+
+        if path.endswith("/stac/v1"):
+            return self.send_json(200, {
+                "type": "Catalog", "id": "api", "description": "Mock STAC API", "stac_version": "1.0.0",
+                "conformsTo": [
+                    "https://api.stacspec.org/v1.0.0/core",
+                    "https://api.stacspec.org/v1.0.0/item-search",
+                    "https://api.stacspec.org/v1.0.0/collections",
+                    "http://www.opengis.net/spec/ogcapi-features-1/1.0/conf/core"
+                ],
+                "links": [
+                    {"rel": "self", "href": f"{api}/"},
+                    {"rel": "root", "href": f"{api}/"},
+                    {"rel": "search", "href": f"{api}/search", "type": "application/geo+json", "method": "POST"},
+                    {"rel": "data", "href": f"{api}/collections", "type": "application/json"}
+                ]
+            })
+        if path.endswith("/collections"):
+            return self.send_json(200, {"collections": [self._collection(c) for c in self.owner.collections], "links": []})
+        if "/collections/" in path and path.split("/collections/")[1] in self.owner.collections:
+            return self.send_json(200, self._collection(path.split("/collections/")[1]))
+        if path.endswith("/search"):
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if "collections" in query:
+                query["collections"] = query["collections"].split(",")
+            return self.send_json(200, self._search(query))
+        self.send_json(404, {})
+
+    def _write(self):
+        content = self.read_json()
+        path = urlparse(self.path).path.rstrip("/")
+        if path.endswith("/search"):
+            self.owner.count("stac_api")
+            return self.send_json(200, self._search(content or {}))
+
+        self.owner.count(f"oseo_{self.command.lower()}")
+        if "/products" in path:
+            with self.owner.lock:
+                if self.command == "POST":
+                    self.owner.products[content["properties"]["eop:identifier"]] = content
+                elif self.command == "PUT":
+                    self.owner.products[path.rsplit("/", 1)[1]] = content
+                else:
+                    self.owner.products.pop(path.rsplit("/", 1)[1], None)
+        elif self.command == "POST" and path.endswith("/collections"):
+            with self.owner.lock:
+                self.owner.collections.setdefault(content["properties"]["name"], None)
+        self.send_json(201 if self.command == "POST" else 200, {})
+
+    do_POST = do_PUT = do_DELETE = _write
+
+class MockGeoServer(_Server):
+
+    """
+    Stand-in for the CSC GeoServer: a STAC API (landing page, collections and paged item search)
+    and the OSEO REST API, which records the written products. Requests are counted per stage:
+    stac_api and oseo_<method>.
+
+    collections - Dictionary of collection id to the URL of the FMI collection it is derived from
+    latency - Seconds waited before every response
+    """
+
+    def __init__(self, collections, latency=0.0):
+        self.collections = dict(collections)
+        self.products = {}
+        self.lock = threading.Lock()
+        super().__init__(_ApiHandler, latency)
+
+    def reset(self):
+        with self.lock:
+            self.products.clear()
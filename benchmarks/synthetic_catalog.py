@@ -0,0 +1,116 @@
+import json
+from pathlib import Path
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+RASTER_FILE = "asset.tif"
+
+def collection_name(index):
+    return f"Bench_{index}"
+
+def write_cog(path, size=256):
+    """
+    Writes a small single band Cloud Optimized GeoTIFF in ETRS-TM35FIN, the projection of the FMI rasters.
+    """
+
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff", width=size, height=size, count=1, dtype="uint8",
+            crs="EPSG:3067", transform=from_origin(300000, 7000000, 10, 10)
+        ) as dataset:
+            dataset.write(np.zeros((1, size, size), "uint8"))
+        with memfile.open() as src:
+            rasterio.shutil.copy(src, str(path), driver="COG")
+
+def _extent():
+    # The temporal interval is not nested, like in some FMI collections, so the repairs of the loader are exercised
+    return {
+        "spatial": {"bbox": [[19.0, 59.0, 32.0, 71.0]]},
+        "temporal": {"interval": ["2020-01-01T00:00:00Z", "2021-01-01T00:00:00Z"]}
+    }
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(content, f)
+
+def generate_catalog(root, base_url, collections=2, children=4, items=50, raster_size=256):
+    """
+    Writes a synthetic static catalog in the layout of the FMI catalog: collections whose child links point to
+    sub-collections, whose item links point to the items. Every item has one COG asset. The asset URLs are all
+    different but are served from the same file, see servers.StaticCatalogServer.
+    Returns the list of collection URLs.
+
+    root - Directory the catalog is written to
+    base_url - URL the catalog is served from
+    collections - Number of collections
+    children - Number of sub-collections per collection
+    items - Number of items per sub-collection
+    raster_size - Width and height of the COG in pixels
+    """
+
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    write_cog(root / RASTER_FILE, raster_size)
+
+    collection_urls = []
+    for c in range(collections):
+        name = collection_name(c)
+        child_links = []
+        for s in range(children):
+            item_links = []
+            for i in range(items):
+                item_id = f"{name}_{s}_{i}"
+                x = 20.0 + (i % 10)
+                y = 60.0 + (s % 10)
+                _write(root / name / "items" / f"{item_id}.json", {
+                    "type": "Feature",
+                    "stac_version": "1.0.0",
+                    "id": item_id,
+                    "collection": name,
+                    "geometry": {"type": "Polygon", "coordinates": [[[x, y], [x + 1, y], [x + 1, y + 1], [x, y + 1], [x, y]]]},
+                    "bbox": [x, y, x + 1, y + 1],
+                    "properties": {
+                        "datetime": None,
+                        "start_datetime": f"2020-{s % 12 + 1:02d}-01T00:00:00Z",
+                        "end_datetime": f"2020-{s % 12 + 1:02d}-28T00:00:00Z"
+                    },
+                    "license": "CC-BY-4.0",
+                    "links": [
+                        {"rel": "license", "href": "https://creativecommons.org/licenses/by/4.0/"},
+                        {"rel": "collection", "href": f"{base_url}/{name}/{name}_{s}.json", "type": "application/json"}
+                    ],
+                    "assets": {
+                        "data": {"href": f"{base_url}/assets/{item_id}.tif", "type": "image/tiff; application=geotiff; profile=cloud-optimized", "roles": "data"}
+                    }
+                })
+                item_links.append({"rel": "item", "href": f"{base_url}/{name}/items/{item_id}.json", "type": "application/geo+json"})
+
+            _write(root / name / f"{name}_{s}.json", {
+                "type": "Collection",
+                "stac_version": "1.0.0",
+                "id": f"{name}_{s}",
+                "description": f"Sub-collection {s} of {name}",
+                "license": "CC-BY-4.0",
+                "extent": _extent(),
+                "links": item_links
+            })
+            child_links.append({"rel": "child", "href": f"{base_url}/{name}/{name}_{s}.json", "type": "application/json"})
+
+        _write(root / name / f"{name}.json", {
+            "type": "Collection",
+            "stac_version": "1.0.0",
+            "id": name,
+            "title": name,
+            "description": f"Synthetic collection {name}",
+            "license": "CC-BY-4.0",
+            "summaries": {"gsd": [10]},
+            "extent": _extent(),
+            "links": child_links
+        })
+        collection_urls.append(f"{base_url}/{name}/{name}.json")
+
+    return collection_urls
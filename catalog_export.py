@@ -0,0 +1,156 @@
+import threading
+from pathlib import Path
+from pystac.utils import str_to_datetime
+import json_backend
+
+# pyarrow and shapely are only needed for the GeoParquet export
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from shapely.geometry import shape
+except ImportError:
+    pa = None
+
+EXPORT_FORMATS = ["ndjson", "parquet"]
+
+# Number of rows the GeoParquet export keeps in memory before it writes them as a row group
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+# GeoParquet 1.0.0 metadata of the geometry column. Without a crs the geometries are in OGC:CRS84, as in STAC.
+# The geometry types are not known when the file is opened, an empty list stands for any type
+GEOPARQUET_METADATA = {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+}
+
+class NdjsonExport:
+
+    """
+    Writes the items of a collection into one newline-delimited JSON file, one item dictionary per line.
+
+    path - Path of the .ndjson file
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "wb")
+
+    def add(self, item_dict):
+        line = json_backend.dumps(item_dict) + b"\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class GeoParquetExport:
+
+    """
+    Writes the items of a collection into a GeoParquet table with one row per item: id, collection, geometry,
+    datetime, start_datetime, end_datetime, gsd, proj:epsg, proj:transform and the asset hrefs as a JSON object.
+    Every row_group_size rows are written as a row group, so the memory used does not grow with the collection.
+
+    path - Path of the .parquet file
+    row_group_size - Number of rows kept in memory before they are written
+    """
+
+    def __init__(self, path, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        if pa is None:
+            raise RuntimeError("The GeoParquet export needs pyarrow and shapely, install them with pip install pyarrow shapely")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.row_group_size = max(1, int(row_group_size))
+        timestamp = pa.timestamp("us", tz="UTC")
+        self.schema = pa.schema([
+            ("id", pa.string()),
+            ("collection", pa.string()),
+            ("geometry", pa.binary()),
+            ("datetime", timestamp),
+            ("start_datetime", timestamp),
+            ("end_datetime", timestamp),
+            ("gsd", pa.float64()),
+            ("proj:epsg", pa.int64()),
+            ("proj:transform", pa.list_(pa.float64())),
+            ("assets", pa.string()),
+        ], metadata={"geo": json_backend.dumps(GEOPARQUET_METADATA)})
+        self._lock = threading.Lock()
+        self._rows = []
+        self._writer = pq.ParquetWriter(self.path, self.schema)
+
+    def add(self, item_dict):
+        properties = item_dict["properties"]
+        row = {
+            "id": item_dict["id"],
+            "collection": item_dict.get("collection"),
+            "geometry": shape(item_dict["geometry"]).wkb if item_dict.get("geometry") else None,
+            **{
+                key: str_to_datetime(properties[key]) if properties.get(key) else None
+                for key in ("datetime", "start_datetime", "end_datetime")
+            },
+            "gsd": item_dict.get("gsd"),
+            "proj:epsg": item_dict.get("proj:epsg"),
+            "proj:transform": item_dict.get("proj:transform"),
+            "assets": json_backend.dumps({key: asset["href"] for key, asset in item_dict["assets"].items()}).decode("utf-8"),
+        }
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        # Called with the lock held
+        if self._rows:
+            rows, self._rows = self._rows, []
+            self._writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._writer.close()
+
+EXPORTS = {
+    "ndjson": ("items.ndjson", NdjsonExport),
+    "parquet": ("items.parquet", GeoParquetExport),
+}
+
+class CatalogExport:
+
+    """
+    The exports of one collection, every item added is passed to each of them.
+
+    directory - Directory of the collection, the export files are written into it
+    formats - List of export formats, see EXPORT_FORMATS
+    """
+
+    def __init__(self, directory, formats):
+        self.exports = [EXPORTS[name][1](Path(directory) / EXPORTS[name][0]) for name in formats]
+
+    def add(self, item_dict):
+        for export in self.exports:
+            export.add(item_dict)
+
+    def close(self):
+        for export in self.exports:
+            export.close()
+
+def read_ndjson(path):
+    """
+    Generator of the item dictionaries of an NDJSON export, read line by line.
+    """
+
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json_backend.loads(line)
+
+def count_lines(path):
+    """
+    Returns the number of items in an NDJSON export without parsing them.
+    """
+
+    with open(path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
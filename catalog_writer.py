@@ -0,0 +1,45 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pystac import StacIO
+import metrics
+
+DEFAULT_WRITE_WORKERS = 4
+
+class CatalogWriter:
+
+    """
+    Writes the JSON files of a local catalog from a pool of worker threads, so that encoding and writing an item
+    does not hold up the next one. The number of files waiting to be written is bounded.
+
+    stac_io - StacIO used to write the files, the default StacIO if not given
+    workers - Number of files written at the same time
+    """
+
+    def __init__(self, stac_io=None, workers=DEFAULT_WRITE_WORKERS):
+        self.stac_io = stac_io or StacIO.default()
+        self.workers = max(1, int(workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._queued = threading.BoundedSemaphore(self.workers * 4)
+
+    def _write(self, href, content):
+        try:
+            with metrics.timer("write"):
+                self.stac_io.save_json(href, content)
+        finally:
+            self._queued.release()
+
+    def write(self, href, content):
+        """
+        Queues the dictionary content to be written to href. Blocks while too many files are waiting.
+        Returns a Future that is done when the file is on disk.
+        """
+
+        self._queued.acquire()
+        return self._executor.submit(self._write, href, content)
+
+    def close(self):
+        """
+        Waits until all queued files have been written and the done callbacks of their Futures have run.
+        """
+
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+class Checkpoint:
+
+    """
+    Durable journal of the work a run has completed, so that an interrupted run can be resumed where it stopped.
+    Entries are grouped by scope (a collection id) and kind ("collection", "item", "upload"), each entry can carry a JSON value.
+    Every entry is committed as soon as it is marked.
+
+    path - Path of the SQLite file of the journal
+    resume - If False the journal of the previous run is cleared and the run starts from the beginning
+    """
+
+    def __init__(self, path, resume=False):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS journal (scope TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (scope, kind, key))"
+        )
+        if not resume:
+            self._db.execute("DELETE FROM journal")
+        self._db.commit()
+
+    def __reduce__(self):
+        # A worker process opens the same journal and continues it
+        return (Checkpoint, (self.path, True))
+
+    def mark(self, scope, kind, key, value=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO journal (scope, kind, key, value) VALUES (?, ?, ?, ?)",
+                (scope, kind, key, json.dumps(value))
+            )
+            self._db.commit()
+
+    def done(self, scope, kind, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM journal WHERE scope = ? AND kind = ? AND key = ?", (scope, kind, key)
+            ).fetchone()
+        return row is not None
+
+    def entries(self, scope, kind):
+        """
+        Returns a dictionary of key to value of all entries of the kind in the scope.
+        """
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, value FROM journal WHERE scope = ? AND kind = ?", (scope, kind)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
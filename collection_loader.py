@@ -0,0 +1,46 @@
+from pystac import Collection, StacIO
+from pystac.utils import is_absolute_href, make_absolute_href, make_posix_style
+
+# Registry of repairs for known errors in the FMI catalog JSON, applied in order to every loaded collection
+REPAIRS = []
+
+def repair(function):
+    """
+    Decorator that adds a function to the repair registry. The function gets the collection dictionary,
+    fixes it in place and returns True if it changed something.
+    """
+
+    REPAIRS.append(function)
+    return function
+
+@repair
+def nest_temporal_interval(data):
+    # Some collections have wrongly configured Temporal Extents: a single [start, end] instead of a list of intervals
+    interval = data.get("extent", {}).get("temporal", {}).get("interval")
+    if interval and not isinstance(interval[0], list):
+        data["extent"]["temporal"]["interval"] = [interval]
+        return True
+    return False
+
+def repair_collection(data):
+    """
+    Applies all registered repairs to a collection dictionary. Returns the names of the repairs that changed it.
+    """
+
+    return [function.__name__ for function in REPAIRS if function(data)]
+
+def load_collection(href, stac_io=None):
+    """
+    Loads a collection from the FMI catalog. The JSON is fetched once, repaired in memory and the Collection is made from it.
+
+    href - URL or path of the collection
+    stac_io - StacIO used to read the JSON. The default StacIO is used if not given, which reads through the HTTP cache
+    """
+
+    href = make_posix_style(href)
+    if not is_absolute_href(href):
+        href = make_absolute_href(href)
+
+    data = (stac_io or StacIO.default()).read_json(href)
+    repair_collection(data)
+    return Collection.from_dict(data, href=href, migrate=True, preserve_dict=False)
@@ -1,25 +1,28 @@
-import json
+import json_backend
 import getpass
 import argparse
 from pathlib import Path
-import requests
 import pystac_client
-from requests.auth import HTTPBasicAuth
-from urllib.parse import urljoin
+from stac_api import list_item_ids
+from sync import SyncManifest, content_hash
+from geoserver import GeoServerWriter, DEFAULT_UPLOAD_WORKERS
+from catalog_export import read_ndjson, count_lines
+from oseo_database import ProductDatabase, BulkProductWriter, DEFAULT_BATCH_SIZE
+from retry import Retrier, default_policies, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BUDGET
+import metrics
+import rate_limit
+import profiling
 
-def json_convert(jsonfile):
+def json_convert(content):
 
     """
-        jsonfile: json file in dict format
+        content: STAC json file in dict format
         
         A function to map the Sentinel-2 STAC jsonfiles into the GeoServer database layout.
         There are different json layouts for Collections and Items. The function checks if the jsonfile is of type "Collection",
         or of type "Feature" (=Item). A number of properties are hardcoded into Sentinel-2 metadata as these are not collected in the STAC jsonfiles.
     """
 
-    with open(jsonfile) as f:
-        content = json.load(f)
-    
     if content["type"] == "Collection":
 
         new_json = {
@@ -109,76 +112,169 @@ def json_convert(jsonfile):
             new_json["properties"]["timeStart"] = content["properties"]["datetime"]
             new_json["properties"]["timeEnd"] = content["properties"]["datetime"]
 
-    return json.loads(json.dumps(new_json))
+    return new_json
 
-if __name__ == "__main__":
+def upload_collection(collection_folder, catalog, writer, manifest_dir, from_ndjson=False, force=False):
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
-    
-    args = parser.parse_args()
-
-    pwd = getpass.getpass()
-
-    collection_name = "sentinel_2_annual_mosaics_at_fmi"
-
-    workingdir = Path(__file__).parent
-    collection_folder = workingdir / "FMI" / collection_name
+    """
+    Uploads one collection of the local FMI catalog. Products are only written when they are not on the server yet
+    or when they differ from what was uploaded the last time, which is recorded in a manifest of product hashes.
+    Returns the number of items and the WriteResults of the failed writes.
 
-    app_host = f"{args.host}/geoserver/rest/oseo/"
+    collection_folder - Folder of the collection with its collection.json
+    catalog - pystac_client Client of the STAC API
+    writer - GeoServerWriter or BulkProductWriter
+    manifest_dir - Directory of the upload manifests
+    from_ndjson - Read the items from the items.ndjson export of the collection
+    force - Write every product, whether it changed or not
+    """
 
-    if args.host == "http://86.50.229.158:8080/":
-        catalog = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/")
-    else:
-        catalog = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+    rootcollection = json_backend.load_file(collection_folder / "collection.json")
+    collection_name = rootcollection["id"]
 
     # Convert the STAC collection json into json that GeoServer can handle
-    converted = json_convert(collection_folder / "collection.json")
+    converted = json_convert(rootcollection)
 
     #Additional code for changing collection data if the collection already exists
     collections = catalog.get_collections()
     col_ids = [col.id for col in collections]
     if collection_name in col_ids:
-        r = requests.put(urljoin(app_host + "collections/", collection_name), json=converted, auth=HTTPBasicAuth("admin", pwd))
-        r.raise_for_status()
+        writer.request("PUT", f"collections/{collection_name}", json=converted)
         print(f"Updated {collection_name}")
     else:
-        r = requests.post(urljoin(app_host, "collections/"), json=converted, auth=HTTPBasicAuth("admin", pwd))
-        r.raise_for_status()
+        writer.request("POST", "collections/", json=converted)
         print(f"Added new collection: {collection_name}")
 
-    # Get the posted items from the specific collection
-    posted = catalog.search(collections=[collection_name]).item_collection()
-    posted_ids = [x.id for x in posted]
+    # Get the ids of the posted items from the specific collection
+    posted_ids = list_item_ids(catalog, collection_name)
     print(f"Number of uploaded items: {len(posted_ids)}")
 
-    with open(collection_folder / "collection.json") as f:
-        rootcollection = json.load(f)
+    manifest = SyncManifest.load(Path(manifest_dir) / f"{collection_name}.json")
 
-    items = [x['href'] for x in rootcollection["links"] if x["rel"] == "item"]
+    if from_ndjson:
+        # The items are streamed from the NDJSON export of the collection, one line at a time
+        ndjson_file = collection_folder / "items.ndjson"
+        item_count = count_lines(ndjson_file)
+        payloads = read_ndjson(ndjson_file)
+    else:
+        items = [x['href'] for x in rootcollection["links"] if x["rel"] == "item"]
+        item_count = len(items)
+        # Each item file is read once
+        payloads = (json_backend.load_file(collection_folder / item) for item in items)
+
+    written_hashes = {}
+    unchanged = 0
 
     print("Uploading items:")
-    for i, item in enumerate(items):
+    for i, payload in enumerate(payloads):
 
-        with open(collection_folder / item) as f:
-            payload = json.load(f)
         # Convert the STAC item json into json that GeoServer can handle
-        converted = json_convert(collection_folder / item)
-        request_point = f"collections/{rootcollection['id']}/products"
-        if payload["id"] in posted_ids:
-            request_point = f"collections/{rootcollection['id']}/products/{payload['id']}"
-            r = requests.put(urljoin(app_host, request_point), json=converted, auth=HTTPBasicAuth("admin", pwd))
-            r.raise_for_status()
+        with metrics.timer("convert"):
+            converted = json_convert(payload)
+            converted_hash = content_hash(converted)
+        if payload["id"] not in posted_ids:
+            writer.post_product(collection_name, converted, key=payload['id'])
+            written_hashes[payload["id"]] = converted_hash
+        elif force or manifest.converted_hash(payload["id"]) != converted_hash:
+            writer.put_product(collection_name, payload['id'], converted, key=payload['id'])
+            written_hashes[payload["id"]] = converted_hash
         else:
-            r = requests.post(urljoin(app_host, request_point), json=converted, auth=HTTPBasicAuth("admin", pwd))
-            r.raise_for_status()
-        if len(items) >= 5: # Just to keep track that the script is still running
-            if i == int(len(items) / 5):
+            # The same product was uploaded the last time
+            unchanged += 1
+        if item_count >= 5: # Just to keep track that the script is still running
+            if i == int(item_count / 5):
                 print("~20% of items added")
-            elif i == int(len(items) / 5) * 2:
+            elif i == int(item_count / 5) * 2:
                 print("~40% of items added")
-            elif i == int(len(items) / 5) * 3:
+            elif i == int(item_count / 5) * 3:
                 print("~60% of items added")
-            elif i == int(len(items) / 5) * 4:
+            elif i == int(item_count / 5) * 4:
                 print("~80% of items added")
-    print("All items added.")
\ No newline at end of file
+
+    # Errors are reported per item, the other items are still uploaded
+    errors = []
+    for result in writer.drain():
+        if result.ok:
+            manifest.record(result.key, None, written_hashes[result.key])
+        else:
+            errors.append(result)
+    manifest.save()
+    print(f"{len(written_hashes)} products written, {unchanged} unchanged in {collection_name}")
+    return item_count, errors
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
+    parser.add_argument("--collections", nargs="+", default=None, help="Ids of the collections to upload, all collections in the FMI folder if not given")
+    parser.add_argument("--catalog-dir", type=Path, default=Path(__file__).parent / "FMI", help="Folder of the local catalog made by fmi_to_stac.py")
+    parser.add_argument("--cache-dir", type=Path, default=Path(__file__).parent / ".cache", help="Directory for the upload manifests")
+    parser.add_argument("--force", action="store_true", help="Write every product, also the ones that have not changed since the last upload")
+    parser.add_argument("--upload-workers", type=int, default=DEFAULT_UPLOAD_WORKERS, help="Number of concurrent product writes to GeoServer")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Maximum attempts of a request that fails with a timeout or a server error")
+    parser.add_argument("--db", type=str, default=None, help="Connection string of the OSEO database. Writes the products straight to the database in batches")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of products per database transaction with --db")
+    parser.add_argument("--from-ndjson", action="store_true", help="Read the items from the items.ndjson export of the collection (fmi_to_stac.py --export ndjson)")
+    parser.add_argument("--retry-budget", type=int, default=DEFAULT_RETRY_BUDGET, help="Maximum number of retries in the whole run")
+    parser.add_argument("--metrics", type=Path, default=None, help="JSON file for the run report with the timings and counters of each stage")
+    parser.add_argument("--prometheus", type=Path, default=None, help="File for the metrics of the run in the Prometheus text format")
+    parser.add_argument("--profile", type=str, default=None, help="Id of a collection whose run is profiled with cProfile, tracemalloc and stack sampling. The profile is written next to the --metrics report, or into the profile folder")
+    parser.add_argument("--adaptive", action="store_true", help="Adapt the number of concurrent requests to each host to its latency and errors")
+    parser.add_argument("--host-limit", nargs="+", default=[], help="Starting concurrency of a host as host=N, e.g. 86.50.229.158:8080=8. Implies --adaptive")
+    parser.add_argument("--host-rate", nargs="+", default=[], help="Maximum requests per second to a host as host=R. Implies --adaptive")
+    parser.add_argument("--latency-target", type=float, default=None, help="With --adaptive, responses slower than this many seconds also lower the concurrency of the host")
+    
+    args = parser.parse_args()
+
+    pwd = getpass.getpass()
+
+    app_host = f"{args.host}/geoserver/rest/oseo/"
+
+    if args.host == "http://86.50.229.158:8080/":
+        catalog = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/")
+    else:
+        catalog = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+
+    retrier = Retrier(default_policies(args.max_attempts), budget=args.retry_budget)
+
+    # Concurrency and rate limits of the GeoServer writes
+    rate_limit.install(rate_limit.from_args(args.adaptive, args.host_limit, args.host_rate, args.latency_target))
+
+    writer = GeoServerWriter(app_host, ("admin", pwd), workers=args.upload_workers, retrier=retrier)
+    if args.db:
+        # Bulk mode: the products go straight to the OSEO database, --batch-size products per transaction
+        writer = BulkProductWriter(writer, ProductDatabase(args.db), batch_size=args.batch_size, retrier=retrier)
+
+    # Every collection of the local catalog, or only the ones asked for
+    collection_folders = [path.parent for path in sorted(args.catalog_dir.glob("*/collection.json"))]
+    if args.collections:
+        collection_folders = [folder for folder in collection_folders if folder.name in args.collections]
+
+    item_count = 0
+    errors = []
+    profile_dir = args.metrics.parent if args.metrics else Path("profile")
+    for collection_folder in collection_folders:
+        try:
+            if collection_folder.name == args.profile:
+                with profiling.profile(profile_dir, f"fmi_to_geoserver_{collection_folder.name}"):
+                    collection_items, collection_errors = upload_collection(collection_folder, catalog, writer, args.cache_dir / "upload", from_ndjson=args.from_ndjson, force=args.force)
+            else:
+                collection_items, collection_errors = upload_collection(collection_folder, catalog, writer, args.cache_dir / "upload", from_ndjson=args.from_ndjson, force=args.force)
+        except Exception as e:
+            print(f"ERROR {e} in collection {collection_folder.name}")
+            continue
+        item_count += collection_items
+        errors.extend(collection_errors)
+
+    writer.close()
+    for result in errors:
+        print(f"ERROR {result.error} in item {result.key}")
+    retrier.report()
+    print(metrics.METRICS.summary())
+    if rate_limit.LIMITERS:
+        print(rate_limit.LIMITERS.summary())
+    metrics.METRICS.save(args.metrics, args.prometheus, script="fmi_to_geoserver", items=item_count, failed=len(errors), retries=retrier.retries, dead_letters=len(retrier.dead_letters))
+    if errors:
+        print(f"{len(errors)} of {item_count} items failed.")
+    else:
+        print("All items added.")
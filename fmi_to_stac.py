@@ -1,7 +1,20 @@
-from pystac import Catalog, Collection
+from pystac import Catalog, StacIO
 import pystac
-import rasterio
-import urllib.request, json
+import argparse
+from pathlib import Path
+from harvest import DEFAULT_WORKERS, discover_item_links
+from collection_loader import load_collection
+from raster_metadata import RasterMetadataCache, cached_raster_metadata, item_raster_href, DEFAULT_CACHE_DIR
+from pipeline import Pipeline, Stage
+from checkpoint import Checkpoint
+from catalog_writer import CatalogWriter, DEFAULT_WRITE_WORKERS
+from catalog_export import CatalogExport, EXPORT_FORMATS
+import json_backend
+from retry import Retrier, default_policies, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BUDGET
+from scheduler import CollectionSizes, run_collections
+import http_cache
+import metrics
+import rate_limit
 
 fmi_collections = [
     "https://pta.data.lit.fmi.fi/stac/catalog/Sentinel-2_global_mosaic_vuosi/Sentinel-2_global_mosaic_vuosi.json",
@@ -483,143 +496,317 @@ news_ids = {
     "Tuulituhoriski": "daily_wind_damage_risk_at_fmi"
 }
 
-def retry_errors(list_of_items, list_of_errors):
+def harvest_collection(href, workers=DEFAULT_WORKERS, raster_cache=None, checkpoint=None, retrier=None, output_dir="FMI", write_workers=DEFAULT_WRITE_WORKERS, export=()):
 
-    print("TRYING TO ADD ERRORED ITEMS")
-    while len(list_of_errors) > 0:
-        for i,item in enumerate(list_of_errors):
-            try:
-                list_of_items.append(pystac.Item.from_file(item))
-                print(f"Added item {item}")
-                list_of_errors.remove(item)
-            except Exception as e:
-                print(f"ERROR {e} in item {item} #{i}")
+    """
+    Harvests one FMI collection: loads the collection and its sub-collections, fetches and probes the items and
+    writes the items and the collection.json under output_dir. Runs on its own, so it can be run in a worker process.
+    Returns the id and title of the collection and the number of its items.
 
-    return 0
+    href - URL of the collection in the FMI catalog
+    workers - Number of concurrent item requests and raster reads
+    raster_cache - Optional RasterMetadataCache
+    checkpoint - Optional Checkpoint journal of the written items and collections
+    retrier - Retrier for all network calls
+    output_dir - Directory of the root catalog
+    write_workers - Number of item files written at the same time
+    export - List of compact export formats written next to the collection.json, see catalog_export.EXPORT_FORMATS
+    """
 
-def create_fmi_collections():
-    root_catalog = Catalog(id="FMI", description="Testing catalog", catalog_type= pystac.CatalogType.RELATIVE_PUBLISHED)
-    collections = []
-    for collection in fmi_collections:
-        try:
-            collections.append(Collection.from_file(collection))
-        except ValueError:
-            with urllib.request.urlopen(collection) as url:
-                data = json.load(url)
-                data["extent"]["temporal"]["interval"] = [data["extent"]["temporal"]["interval"]]
-                collections.append(Collection.from_dict(data))
-
-    for collection in collections:
-
-        collection.id = news_ids[collection.id]
-        
-        collection_links = collection.get_child_links()
-
-        sub_collections = []
-        for link in collection_links:
-            try:
-                sub_collections.append(Collection.from_file(link.target))
-            except ValueError:
-                with urllib.request.urlopen(link.target) as url:
-                    data = json.load(url)
-                    data["extent"]["temporal"]["interval"] = [data["extent"]["temporal"]["interval"]]
-                    sub_collections.append(Collection.from_dict(data))
-        # sub_collections = [Collection.from_file(link.target) for link in collection_links]
-        print(f"Number of subcollections in {collection.id}: {len(sub_collections)}")
-        item_links = list(set([link.target for sub in sub_collections for link in sub.get_item_links()]))
-        print(f"Number of item links in {collection.id}: {len(item_links)}")
-        items = []
-        errors = []
-        for i,item in enumerate(item_links):
-            try:
-                items.append(pystac.Item.from_file(item))
-            except Exception as e:
-                print(f"ERROR {e} in item {item} #{i}")
-                errors.append(item)
-        print(f"Number of items in {collection.id}: {len(items)}", flush=True)
-
-        # collection.clear_children()
-        collection.remove_links("child")
-        collection.remove_links("license")
-
-        collection.title = collection_info[collection.id]["title"]
-        collection.description = collection_info[collection.id]["description"]
-        collection.providers = collection_info[collection.id]["providers"]
-        collection.extra_fields["derived_from"] = collection_info[collection.id]["original_href"]
-        collection.license = collection_info[collection.id]["license"]
-        if collection_info[collection.id]["metadata"]:
-            collection.add_link(pystac.Link(
-                rel="metadata",
-                target=collection_info[collection.id]["metadata"],
-                title="Metadata"
-            ))
-            collection.add_asset(
-                key="metadata",
-                asset=pystac.Asset(
-                    href=collection_info[collection.id]["metadata"],
-                    title="Metadata",
-                    roles=[
-                        "metadata"
-                    ]
-                )
+    retrier = retrier or Retrier()
+    stac_io = StacIO.default()
+
+    with metrics.timer("collection"):
+        collection = retrier.call("collection", href, load_collection, href)
+
+    collection.id = news_ids[collection.id]
+    
+    collection_links = collection.get_child_links()
+
+    # collection.clear_children()
+    collection.remove_links("child")
+    collection.remove_links("license")
+
+    collection.title = collection_info[collection.id]["title"]
+    collection.description = collection_info[collection.id]["description"]
+    collection.providers = collection_info[collection.id]["providers"]
+    collection.extra_fields["derived_from"] = collection_info[collection.id]["original_href"]
+    collection.license = collection_info[collection.id]["license"]
+    if collection_info[collection.id]["metadata"]:
+        collection.add_link(pystac.Link(
+            rel="metadata",
+            target=collection_info[collection.id]["metadata"],
+            title="Metadata"
+        ))
+        collection.add_asset(
+            key="metadata",
+            asset=pystac.Asset(
+                href=collection_info[collection.id]["metadata"],
+                title="Metadata",
+                roles=[
+                    "metadata"
+                ]
             )
-        if collection_info[collection.id]["licenseURL"]:
-            collection.add_link(pystac.Link(
-                rel="license",
-                target=collection_info[collection.id]["licenseURL"],
-                title="License"
-            ))
-
-        # If there were connection errors during the item making process, the item generation for errors is retried
-        if len(errors) > 0:
-            retry_errors(items, errors)
-            print("All errors fixed")
-
-        for i,item in enumerate(items):
-
-            with rasterio.open(next(iter(item.assets.values())).href) as src:
-                item.extra_fields["gsd"] = src.res[0]
-                # 9391 EPSG code is false, replace by the standard 3067
-                if src.crs.to_epsg() == 9391:
-                    item.extra_fields["proj:epsg"] = 3067
-                else:
-                    item.extra_fields["proj:epsg"] = src.crs.to_epsg()
-                item.extra_fields["proj:transform"] = [
-                    src.transform.a,
-                    src.transform.b,
-                    src.transform.c,
-                    src.transform.d,
-                    src.transform.e,
-                    src.transform.f,
-                    src.transform.g,
-                    src.transform.h,
-                    src.transform.i
-                ]
-
-            for asset in item.assets:
-                if item.assets[asset].roles is not list:
-                    item.assets[asset].roles = [item.assets[asset].roles]
-        
-            del item.extra_fields["license"]
-            item.remove_links("license")
-
-            collection.add_item(item)
-            
-            if len(items) >= 5:
-                if i == int(len(items) / 5):
-                    print("~20% of items added")
-                elif i == int(len(items) / 5) * 2:
-                    print("~40% of items added")
-                elif i == int(len(items) / 5) * 3:
-                    print("~60% of items added")
-                elif i == int(len(items) / 5) * 4:
-                    print("~80% of items added")
-
-        root_catalog.add_child(collection)
-        print(f"ITEMS in {collection.id}: {len(items)}")
-
-    root_catalog.normalize_and_save('FMI')
+        )
+    if collection_info[collection.id]["licenseURL"]:
+        collection.add_link(pystac.Link(
+            rel="license",
+            target=collection_info[collection.id]["licenseURL"],
+            title="License"
+        ))
+
+    if checkpoint and checkpoint.done(collection.id, "collection", "saved"):
+        print(f"{collection.id} was completed by the previous run, skipping it")
+        saved = checkpoint.entries(collection.id, "collection")["saved"]
+        return collection.id, saved["title"], saved["items"]
+
+    # The collection is added to a root catalog of the same layout as the one assembled at the end,
+    # which sets its self href and the hrefs of the items
+    root_catalog = Catalog(id="FMI", description="Testing catalog", catalog_type= pystac.CatalogType.RELATIVE_PUBLISHED)
+    root_catalog.normalize_hrefs(output_dir)
+    root_catalog.add_child(collection)
+
+    # Item files are encoded and written by a pool of writer threads
+    catalog_writer = CatalogWriter(stac_io, workers=write_workers)
+
+    # Compact exports of all items of the collection next to its collection.json
+    catalog_export = CatalogExport(Path(collection.get_self_href()).parent, export) if export else None
+
+    # Only the ids of the items are kept, the items themselves are freed once they are handed to the writers
+    item_ids = []
+
+    # Items written by the interrupted run are linked again instead of being fetched
+    written_items = checkpoint.entries(collection.id, "item") if checkpoint else {}
+    for written in written_items.values():
+        collection.add_link(pystac.Link(rel="item", target=written["href"], media_type=pystac.MediaType.GEOJSON))
+        item_ids.append(written["id"])
+        if catalog_export:
+            catalog_export.add(json_backend.load_file(written["href"]))
+    if written_items:
+        print(f"Resuming {collection.id} after {len(written_items)} items")
+
+    def load_sub_collection(href):
+        with metrics.timer("child"):
+            return retrier.call("collection", href, load_collection, href)
+
+    failed_sub_collections = []
+
+    def skip_sub_collection(href, e):
+        print(f"ERROR {e} in sub-collection {href}, skipping its items")
+        failed_sub_collections.append(href)
+
+    # Number of item links still to be written, known once all sub-collections have been loaded
+    discovered = {"item_links": None}
+
+    def item_links():
+        # Sub-collections are loaded concurrently and their item links go to the fetch stage as soon as each one has been loaded
+        count = 0
+        for link in discover_item_links([link.target for link in collection_links], load_sub_collection, workers=workers, on_error=skip_sub_collection):
+            count += 1
+            if link not in written_items:
+                yield link
+        discovered["item_links"] = count - len(written_items)
+        print(f"Number of subcollections in {collection.id}: {len(collection_links) - len(failed_sub_collections)}")
+        print(f"Number of item links in {collection.id}: {count}")
+
+    # Next progress step to report
+    progress = [1]
+
+    # Link of each fetched item, the key of the item in the checkpoint journal
+    item_links_by_id = {}
+
+    def fetch(link):
+        item = retrier.call("item", link, pystac.Item.from_file, link)
+        if checkpoint:
+            item_links_by_id[item.id] = link
+        return item
+
+    def probe(item):
+        # gsd, proj:epsg and proj:transform are read from the raster header
+        href = item_raster_href(item)
+        item.extra_fields.update(retrier.call("raster", href, cached_raster_metadata, href, raster_cache))
+        return item
+
+    # Hrefs and ids of the items whose file could not be written
+    failed_writes = set()
+    failed_ids = set()
+
+    def written(future, link, href, item_id, item_dict):
+        if future.exception() is not None:
+            print(f"ERROR {future.exception()} in writing {href}")
+            failed_writes.add(href)
+            failed_ids.add(item_id)
+            return
+        if catalog_export:
+            catalog_export.add(item_dict)
+        if checkpoint:
+            # An item is journaled once its file is on disk
+            checkpoint.mark(collection.id, "item", link, {"href": href, "id": item_id})
+
+    def write(item):
+
+        for asset in item.assets:
+            if item.assets[asset].roles is not list:
+                item.assets[asset].roles = [item.assets[asset].roles]
+    
+        del item.extra_fields["license"]
+        item.remove_links("license")
+
+        item_link = collection.add_item(item)
+
+        # The item is handed to the file writers right away and only its id is kept
+        item_dict = item.to_dict(include_self_link=False)
+        href = item.get_self_href()
+        item_link.target = href
+        item_ids.append(item.id)
+        future = catalog_writer.write(href, item_dict)
+        future.add_done_callback(lambda future: written(future, item_links_by_id.pop(item.id, None), href, item.id, item_dict))
+
+        # Progress is reported once the number of item links is known
+        total = discovered["item_links"]
+        i = len(item_ids) - 1 - len(written_items)
+        while total is not None and total >= 5 and progress[0] <= 4 and i >= int(total / 5) * progress[0]:
+            print(f"~{progress[0] * 20}% of items added")
+            progress[0] += 1
+
+    # Items that fail even after retrying are skipped and listed in the dead letter report
+    pipeline = Pipeline([
+        Stage("fetch", fetch, workers=workers),
+        Stage("probe", probe, workers=workers),
+    ], on_error=lambda stage, value, e: print(f"ERROR {e} in {stage} of {getattr(value, 'id', value)}"))
+    pipeline.run(item_links(), sink=write)
+
+    # The collection is written once all of its item files are on disk. Closing the writer joins its threads, so the
+    # done callbacks of the writes have also finished: failed_writes is complete and nothing is added to the export later
+    catalog_writer.close()
+    if failed_writes:
+        collection.links = [link for link in collection.links if not (link.rel == "item" and link.target in failed_writes)]
+        item_ids = [item_id for item_id in item_ids if item_id not in failed_ids]
+
+    print(f"ITEMS in {collection.id}: {len(item_ids)}")
+
+    # The items are already on disk, the collection is written once all of them are done
+    if catalog_export:
+        catalog_export.close()
+    collection.save_object(include_self_link=False, stac_io=stac_io)
+    if checkpoint:
+        checkpoint.mark(collection.id, "collection", "saved", {"title": collection.title, "items": len(item_ids)})
+
+    return collection.id, collection.title, len(item_ids)
+
+def create_fmi_collections(workers=DEFAULT_WORKERS, raster_cache=None, retrier=None, checkpoint=None, processes=1, sizes=None, fmi_client=None, write_workers=DEFAULT_WRITE_WORKERS, export=(), profile=None):
+
+    """
+    Harvests all FMI collections and writes the root catalog once every collection is done.
+
+    processes - Number of collections harvested at the same time in worker processes
+    sizes - Optional CollectionSizes, the largest collections of the previous run are started first
+    fmi_client - CachedHttpClient that the worker processes read the FMI catalog through
+    write_workers - Number of item files written at the same time per collection
+    export - List of compact export formats of the items of each collection
+    profile - Optional (collection, directory): the harvest of this collection, given by its FMI name or its new id,
+              is profiled and the profile is written to directory
+    """
+
+    retrier = retrier or Retrier()
+
+    profile_job = None
+    if profile:
+        for href in fmi_collections:
+            fmi_name = href.rsplit("/", 1)[-1].removesuffix(".json")
+            if profile[0] in (fmi_name, news_ids.get(fmi_name)):
+                profile_job = (href, profile[1], f"fmi_to_stac_{news_ids.get(fmi_name, fmi_name)}")
+        if profile_job is None:
+            print(f"ERROR collection {profile[0]} is not harvested, nothing is profiled")
+
+    results = run_collections(
+        harvest_collection,
+        {href: (href,) for href in fmi_collections},
+        processes=processes,
+        sizes=sizes,
+        retrier=retrier,
+        fmi_client=fmi_client,
+        profile=profile_job,
+        workers=workers,
+        raster_cache=raster_cache,
+        checkpoint=checkpoint,
+        write_workers=write_workers,
+        export=export
+    )
+
+    root_catalog = Catalog(id="FMI", description="Testing catalog", catalog_type= pystac.CatalogType.RELATIVE_PUBLISHED)
+    root_catalog.normalize_hrefs('FMI')
+    root_dir = Path(root_catalog.get_self_href()).parent
+
+    # The children are linked in the order of fmi_collections, whatever order they finished in
+    for href in fmi_collections:
+        result = results.get(href)
+        if result is None or isinstance(result, Exception):
+            print(f"ERROR in collection {href}, it is left out of the catalog")
+            continue
+        collection_id, title, item_count = result
+        if sizes:
+            sizes.update(href, item_count)
+        root_catalog.add_link(pystac.Link(
+            rel="child",
+            target=str(root_dir / collection_id / "collection.json"),
+            media_type=pystac.MediaType.JSON,
+            title=title
+        ))
+
+    root_catalog.save_object(stac_io=StacIO.default())
+    if sizes:
+        sizes.save()
     print("Catalog normalized and saved")
 
 if __name__ == "__main__":
-    create_fmi_collections()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of concurrent item requests and raster reads")
+    parser.add_argument("--cache-dir", type=Path, default=DEFAULT_CACHE_DIR, help="Directory for the local caches")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the local caches")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Maximum attempts of a network call that fails with a timeout or a server error")
+    parser.add_argument("--retry-budget", type=int, default=DEFAULT_RETRY_BUDGET, help="Maximum number of retries in the whole run")
+    parser.add_argument("--dead-letters", type=Path, default=Path("dead_letters.json"), help="File for the report of skipped items")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from where it stopped")
+    parser.add_argument("--write-workers", type=int, default=DEFAULT_WRITE_WORKERS, help="Number of item files written at the same time")
+    parser.add_argument("--export", nargs="+", choices=EXPORT_FORMATS, default=[], help="Also write the items of each collection into items.ndjson and/or items.parquet")
+    parser.add_argument("--processes", type=int, default=1, help="Number of collections harvested at the same time in separate processes")
+    parser.add_argument("--metrics", type=Path, default=None, help="JSON file for the run report with the timings and counters of each stage")
+    parser.add_argument("--prometheus", type=Path, default=None, help="File for the metrics of the run in the Prometheus text format")
+    parser.add_argument("--profile", type=str, default=None, help="Id of a collection whose run is profiled with cProfile, tracemalloc and stack sampling. The profile is written next to the --metrics report, or into the profile folder")
+    parser.add_argument("--adaptive", action="store_true", help="Adapt the number of concurrent requests to each host to its latency and errors")
+    parser.add_argument("--host-limit", nargs="+", default=[], help="Starting concurrency of a host as host=N, e.g. pta.data.lit.fmi.fi=8. Implies --adaptive")
+    parser.add_argument("--host-rate", nargs="+", default=[], help="Maximum requests per second to a host as host=R. Implies --adaptive")
+    parser.add_argument("--latency-target", type=float, default=None, help="With --adaptive, responses slower than this many seconds also lower the concurrency of the host")
+
+    args = parser.parse_args()
+
+    # Journal of the completed collections and written items
+    checkpoint = Checkpoint(args.cache_dir / "checkpoint_fmi_to_stac.sqlite", resume=args.resume)
+
+    raster_cache = None if args.no_cache else RasterMetadataCache(args.cache_dir / "raster_metadata.sqlite")
+
+    # FMI catalog JSON is read through a local cache and only downloaded again when it has changed
+    fmi_client = http_cache.CachedHttpClient(None if args.no_cache else http_cache.HttpCache(args.cache_dir / "http.sqlite"))
+    http_cache.install(fmi_client)
+
+    retrier = Retrier(default_policies(args.max_attempts), budget=args.retry_budget)
+
+    # Concurrency and rate limits per host for the catalog fetches and raster reads
+    rate_limit.install(rate_limit.from_args(args.adaptive, args.host_limit, args.host_rate, args.latency_target))
+
+    # Item counts of the previous run, so that the largest collections are started first
+    sizes = CollectionSizes(args.cache_dir / "collection_sizes.json")
+
+    profile = (args.profile, args.metrics.parent if args.metrics else Path("profile")) if args.profile else None
+
+    create_fmi_collections(workers=args.workers, raster_cache=raster_cache, retrier=retrier, checkpoint=checkpoint, processes=args.processes, sizes=sizes, fmi_client=fmi_client, write_workers=args.write_workers, export=args.export, profile=profile)
+    retrier.report(args.dead_letters)
+    # With worker processes the requests of the workers are not counted here
+    print(f"FMI catalog requests: {fmi_client.summary()}")
+    # The metrics include the worker processes
+    print(metrics.METRICS.summary())
+    if rate_limit.LIMITERS:
+        print(rate_limit.LIMITERS.summary())
+    metrics.METRICS.save(args.metrics, args.prometheus, script="fmi_to_stac", retries=retrier.retries, dead_letters=len(retrier.dead_letters))
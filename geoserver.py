@@ -0,0 +1,154 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+import json_backend
+from http_cache import DEFAULT_TIMEOUT
+import metrics
+import rate_limit
+
+DEFAULT_UPLOAD_WORKERS = 8
+
+class WriteResult(namedtuple("WriteResult", ["key", "method", "url", "status_code", "error"])):
+
+    """
+    Outcome of one write. error is None for successful writes.
+    """
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class GeoServerWriter:
+
+    """
+    Writer for the GeoServer OSEO REST API. All requests share one requests.Session whose connection pool
+    is sized for the number of concurrent writes. Product writes are sent from a pool of worker threads with a bounded
+    number of requests in flight. A failed write is reported in its WriteResult and does not stop the other writes.
+
+    app_host - The REST API path, e.g. <host>/geoserver/rest/oseo/
+    auth - (user, password) tuple for the REST API
+    headers - Headers sent with every request
+    workers - Number of product writes in flight at the same time
+    on_result - Optional function called with every WriteResult as the writes complete
+    retrier - Optional Retrier for the requests
+    timeout - Seconds to wait for GeoServer to connect or to answer. A request that times out is retried by the retrier
+    """
+
+    def __init__(self, app_host, auth, headers=None, workers=DEFAULT_UPLOAD_WORKERS, on_result=None, retrier=None, timeout=DEFAULT_TIMEOUT):
+        self.app_host = app_host
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.on_result = on_result
+        self.retrier = retrier
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._in_flight = threading.BoundedSemaphore(self.workers * 2)
+        self._lock = threading.Lock()
+        self._results = []
+        self._pending = []
+
+    def _send(self, method, url, json=None, key=None):
+        # The body is encoded once with the fast JSON backend and sent as is on every attempt
+        body = json_backend.dumps(json) if json is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else None
+
+        def send():
+            metrics.count("requests", stage="geoserver")
+            if body is not None:
+                metrics.count("bytes_uploaded", len(body), stage="geoserver")
+            with rate_limit.slot(url):
+                r = self.session.request(method, url, data=body, headers=headers, timeout=self.timeout)
+                r.raise_for_status()
+            return r
+
+        with metrics.timer("upload"):
+            if self.retrier:
+                return self.retrier.call("upload", key or url, send)
+            return send()
+
+    def request(self, method, request_point, json=None):
+        """
+        Sends a single request and waits for it. Raises for error responses, used for the collection level writes.
+        """
+
+        return self._send(method, urljoin(self.app_host, request_point), json=json)
+
+    def _write(self, key, method, url, json):
+        try:
+            r = self._send(method, url, json=json, key=key)
+            result = WriteResult(key, method, url, r.status_code, None)
+        except requests.HTTPError as e:
+            result = WriteResult(key, method, url, e.response.status_code, f"{e}: {e.response.text[:500]}")
+        except Exception as e:
+            result = WriteResult(key, method, url, None, str(e))
+        finally:
+            self._in_flight.release()
+
+        with self._lock:
+            self._results.append(result)
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def submit(self, method, request_point, json=None, key=None):
+        """
+        Queues a write. Blocks while the maximum number of writes is already in flight.
+        Returns a Future of the WriteResult.
+        """
+
+        self._in_flight.acquire()
+        future = self._executor.submit(self._write, key, method, urljoin(self.app_host, request_point), json)
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def post_product(self, collection_id, product, key=None):
+        return self.submit("POST", f"collections/{collection_id}/products", json=product, key=key)
+
+    def put_product(self, collection_id, product_id, product, key=None):
+        return self.submit("PUT", f"collections/{collection_id}/products/{product_id}", json=product, key=key)
+
+    def delete_product(self, collection_id, product_id, key=None):
+        return self.submit("DELETE", f"collections/{collection_id}/products/{product_id}", key=key)
+
+    def drain(self):
+        """
+        Waits for all queued writes and returns their WriteResults. The results are cleared, so the
+        next call only returns the writes submitted after this one.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+def print_write_result(result):
+    """
+    Default progress output for the writes in the style of the update script.
+    """
+
+    if not result.ok:
+        print(f" ! {result.method} {result.url} failed: {result.error}")
+    elif result.method == "POST":
+        print(f" + Added item {result.key}")
+    elif result.method == "PUT":
+        print(f" ~ Updated item {result.key}")
+    elif result.method == "DELETE":
+        print(f" - Removed item {result.key}")
@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_WORKERS = 8
+
+def discover_item_links(child_hrefs, load, workers=DEFAULT_WORKERS, on_error=None):
+    """
+    Generator that loads the sub-collections of a collection with a bounded pool of worker threads and yields the
+    item links of each sub-collection as soon as it has been loaded. Every link is yielded only once.
+
+    child_hrefs - List of hrefs of the sub-collections
+    load - Function that loads a sub-collection from its href
+    workers - Number of sub-collection requests in flight at the same time
+    on_error - Optional function called with (href, exception) for every sub-collection that could not be loaded.
+               Without it the exception is raised
+    """
+
+    seen = set()
+    workers = max(1, int(workers))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load, href): href for href in child_hrefs}
+        for future in as_completed(futures):
+            href = futures.pop(future)
+            try:
+                sub_collection = future.result()
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(href, e)
+                continue
+
+            for link in sub_collection.get_item_links():
+                if link.target not in seen:
+                    seen.add(link.target)
+                    yield link.target
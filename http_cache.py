@@ -0,0 +1,170 @@
+import sqlite3
+import threading
+from pathlib import Path
+import requests
+from pystac import StacIO
+from pystac.stac_io import DefaultStacIO
+import json_backend
+import metrics
+import rate_limit
+
+DEFAULT_TIMEOUT = 60
+
+class HttpCache:
+
+    """
+    On-disk store of HTTP response bodies together with their ETag and Last-Modified headers.
+
+    path - Path of the SQLite file holding the cache
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=60)
+        # Every put commits, WAL with synchronous=NORMAL keeps the commits from waiting on an fsync each
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB NOT NULL)"
+        )
+        self._db.commit()
+
+    def __reduce__(self):
+        # A worker process opens its own connection to the same cache
+        return (HttpCache, (self.path,))
+
+    def get(self, url):
+        """
+        Returns (etag, last_modified, body) of the cached response for url, or None if url is not cached.
+        """
+
+        with self._lock:
+            return self._db.execute(
+                "SELECT etag, last_modified, body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+
+    def put(self, url, etag, last_modified, body):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (url, etag, last_modified, body) VALUES (?, ?, ?, ?)",
+                (url, etag, last_modified, body)
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class CachedHttpClient:
+
+    """
+    HTTP client for the FMI static catalog. Responses that carry an ETag or Last-Modified header are stored in the cache,
+    later requests for the same URL are sent with If-None-Match/If-Modified-Since and a 304 answer is served from disk.
+    Every thread gets its own pooled requests.Session.
+
+    cache - Optional HttpCache. Without a cache every request downloads the full body
+    headers - Headers sent with every request
+    """
+
+    def __init__(self, cache=None, headers=None, timeout=DEFAULT_TIMEOUT):
+        self.cache = cache
+        self.headers = headers or {}
+        self.timeout = timeout
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "not_modified": 0, "bytes_downloaded": 0, "bytes_from_cache": 0}
+
+    def __reduce__(self):
+        # A worker process gets a client with the same cache and headers, and its own sessions and statistics
+        return (CachedHttpClient, (self.cache, self.headers, self.timeout))
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(self.headers)
+        return self._local.session
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+        for key, value in counts.items():
+            metrics.count(key, value, stage="fmi")
+
+    def get_bytes(self, url):
+        """
+        Returns the body of url, revalidating a cached copy with a conditional request when there is one.
+        """
+
+        cached = self.cache.get(url) if self.cache else None
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        with rate_limit.slot(url):
+            r = self._session().get(url, headers=headers, timeout=self.timeout)
+            if r.status_code != 304 or not cached:
+                r.raise_for_status()
+
+        if r.status_code == 304 and cached:
+            self._count(requests=1, not_modified=1, bytes_from_cache=len(cached[2]))
+            return cached[2]
+
+        body = r.content
+        self._count(requests=1, bytes_downloaded=len(body))
+
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if self.cache and (etag or last_modified):
+            self.cache.put(url, etag, last_modified, body)
+        return body
+
+    def get_text(self, url):
+        return self.get_bytes(url).decode("utf-8")
+
+    def summary(self):
+        return (
+            f"{self.stats['requests']} requests, {self.stats['not_modified']} not modified, "
+            f"{self.stats['bytes_downloaded'] / 1024:.1f} kB downloaded, {self.stats['bytes_from_cache'] / 1024:.1f} kB from cache"
+        )
+
+class CachingStacIO(DefaultStacIO):
+
+    """
+    pystac StacIO that reads remote files through a CachedHttpClient, so Collection.from_file and Item.from_file use the cache.
+    """
+
+    def __init__(self, client, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = client
+
+    def read_json(self, source, *args, **kwargs):
+        # Remote JSON is parsed straight from the bytes of the response
+        href = str(source)
+        if href.startswith(("http://", "https://")):
+            return json_backend.loads(self.client.get_bytes(href))
+        return super().read_json(source, *args, **kwargs)
+
+    def json_loads(self, txt, *args, **kwargs):
+        return json_backend.loads(txt)
+
+    def json_dumps(self, json_dict, *args, **kwargs):
+        return json_backend.dumps(json_dict, indent=True).decode("utf-8")
+
+    def read_text_from_href(self, href):
+        if href.startswith(("http://", "https://")):
+            return self.client.get_text(href)
+        return super().read_text_from_href(href)
+
+def install(client):
+    """
+    Makes the pystac default StacIO read remote files through client.
+    """
+
+    StacIO.set_default(lambda: CachingStacIO(client))
@@ -0,0 +1,45 @@
+import json
+
+# orjson is optional. It parses and encodes several times faster than the standard library, which is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson else "json"
+
+def loads(data):
+    """
+    Parses JSON from bytes or a string.
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(content, sort_keys=False, indent=False):
+    """
+    Encodes content as UTF-8 JSON bytes. Without indent the output is compact.
+
+    sort_keys - Sort the keys of the dictionaries, for output that does not depend on the key order
+    indent - Indent the output by two spaces
+    """
+
+    if orjson is not None:
+        option = (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(content, option=option)
+    return json.dumps(
+        content,
+        sort_keys=sort_keys,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":"),
+        ensure_ascii=False
+    ).encode("utf-8")
+
+def load_file(path):
+    """
+    Reads and parses a JSON file.
+    """
+
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -0,0 +1,249 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+
+    """
+    Latency histogram with fixed buckets. counts[i] is the number of observations that fell into bucket i,
+    the last one counting everything above the largest bound.
+
+    buckets - Upper bounds of the buckets in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Estimate of the q quantile, interpolated linearly inside the bucket it falls into.
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+class Metrics:
+
+    """
+    Timings and counters of a run. Every stage (collection load, item fetch, raster probe, conversion, upload, ...)
+    gets a latency histogram, the number of calls and failed calls and the highest number of calls in flight at
+    the same time. Counters hold everything else, such as bytes transferred and retries, optionally per stage.
+    Thread-safe. The metrics of a worker process are taken with snapshot and added to the parent with merge.
+
+    buckets - Upper bounds of the latency histogram buckets in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.histograms = {}
+            self.errors = {}
+            self.in_flight = {}
+            self.max_in_flight = {}
+            self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Context manager that times one call of stage. A call that raises is counted as an error.
+        """
+
+        with self._lock:
+            self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+            self.max_in_flight[stage] = max(self.max_in_flight.get(stage, 0), self.in_flight[stage])
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.in_flight[stage] -= 1
+                self.histograms.setdefault(stage, Histogram(self.buckets)).observe(seconds)
+                if error:
+                    self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def count(self, name, value=1, stage=None):
+        """
+        Adds value to the counter name, of stage if given.
+        """
+
+        key = (name, stage)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        """
+        Returns the metrics as plain data that can be sent from a worker process and passed to merge.
+        """
+
+        with self._lock:
+            return {
+                "histograms": {stage: (h.counts, h.total, h.count, h.max) for stage, h in self.histograms.items()},
+                "errors": dict(self.errors),
+                "max_in_flight": dict(self.max_in_flight),
+                "counters": list(self.counters.items()),
+            }
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics of a snapshot. The in-flight maximum is the highest of any one process.
+        """
+
+        with self._lock:
+            for stage, (counts, total, count, maximum) in snapshot["histograms"].items():
+                other = Histogram(self.buckets)
+                other.counts, other.total, other.count, other.max = list(counts), total, count, maximum
+                self.histograms.setdefault(stage, Histogram(self.buckets)).merge(other)
+            for stage, errors in snapshot["errors"].items():
+                self.errors[stage] = self.errors.get(stage, 0) + errors
+            for stage, in_flight in snapshot["max_in_flight"].items():
+                self.max_in_flight[stage] = max(self.max_in_flight.get(stage, 0), in_flight)
+            for key, value in snapshot["counters"]:
+                key = tuple(key)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def report(self, **extra):
+        """
+        Returns the run report as a dictionary: the wall time of the run, per stage the number of calls and errors,
+        total and mean seconds, p50/p95/p99 and maximum latency, highest concurrency and the cumulative histogram,
+        and the counters. extra is added to the top level of the report.
+        """
+
+        with self._lock:
+            stages = {}
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip([*map(str, h.buckets), "+Inf"], h.counts):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                stages[stage] = {
+                    "calls": h.count,
+                    "errors": self.errors.get(stage, 0),
+                    "seconds": h.total,
+                    "mean": h.total / h.count if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                    "max": h.max,
+                    "max_in_flight": self.max_in_flight.get(stage, 0),
+                    "buckets": buckets,
+                }
+            counters = {}
+            for (name, stage), value in sorted(self.counters.items(), key=lambda entry: (entry[0][0], entry[0][1] or "")):
+                if stage is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[stage] = value
+
+        return {**extra, "started": self.started, "seconds": time.time() - self.started, "stages": stages, "counters": counters}
+
+    def prometheus(self, prefix="fmi_stac"):
+        """
+        Returns the metrics in the Prometheus text exposition format, e.g. for the textfile collector of node_exporter.
+        """
+
+        report = self.report()
+        lines = [
+            f"# TYPE {prefix}_run_seconds gauge",
+            f"{prefix}_run_seconds {report['seconds']}",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, values in report["stages"].items():
+            for bound, cumulative in values["buckets"].items():
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {values["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {values["calls"]}')
+        lines.append(f"# TYPE {prefix}_stage_errors_total counter")
+        for stage, values in report["stages"].items():
+            lines.append(f'{prefix}_stage_errors_total{{stage="{stage}"}} {values["errors"]}')
+        lines.append(f"# TYPE {prefix}_stage_max_in_flight gauge")
+        for stage, values in report["stages"].items():
+            lines.append(f'{prefix}_stage_max_in_flight{{stage="{stage}"}} {values["max_in_flight"]}')
+        for name, value in report["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            if isinstance(value, dict):
+                lines.extend(f'{prefix}_{name}_total{{stage="{stage}"}} {count}' for stage, count in value.items())
+            else:
+                lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns one line per stage with its calls, latencies and concurrency, the slowest stage in total first.
+        """
+
+        report = self.report()
+        lines = []
+        for stage, values in sorted(report["stages"].items(), key=lambda entry: -entry[1]["seconds"]):
+            lines.append(
+                f"{stage}: {values['calls']} calls, {values['errors']} failed, {values['seconds']:.1f} s in total, "
+                f"mean {values['mean'] * 1000:.1f} ms, p95 {values['p95'] * 1000:.1f} ms, max {values['max'] * 1000:.1f} ms, "
+                f"up to {values['max_in_flight']} in flight"
+            )
+        return "\n".join(lines)
+
+    def save(self, path=None, prometheus_path=None, **extra):
+        """
+        Writes the run report to path as JSON and the Prometheus text to prometheus_path, each if given.
+        """
+
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(self.report(**extra), f, indent=2)
+        if prometheus_path:
+            Path(prometheus_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(prometheus_path, "w") as f:
+                f.write(self.prometheus())
+
+# Metrics of this process. The scripts and the modules they use record into it
+METRICS = Metrics()
+
+def timer(stage):
+    return METRICS.timer(stage)
+
+def count(name, value=1, stage=None):
+    METRICS.count(name, value, stage)
@@ -0,0 +1,249 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from geoserver import WriteResult
+import metrics
+
+# psycopg2 is only needed for the bulk mode
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+DEFAULT_BATCH_SIZE = 500
+
+# Number of full batches waiting for the database or being written, before more products block
+DEFAULT_QUEUED_BATCHES = 2
+
+# Product properties of the converted products and the columns of the OSEO product table they are stored in.
+# These are the columns the OSEO REST API writes for the products of this repository
+PRODUCT_COLUMNS = {
+    "eop:identifier": "eoIdentifier",
+    "eop:parentIdentifier": "eoParentIdentifier",
+    "timeStart": "timeStart",
+    "timeEnd": "timeEnd",
+    "eop:resolution": "eoResolution",
+    "crs": "crs",
+    "projTransform": "projTransform",
+    "assets": "assets",
+}
+
+# Columns stored as JSON
+JSON_COLUMNS = {"assets"}
+
+class ProductDatabase:
+
+    """
+    Direct loader for the PostGIS database behind the GeoServer OSEO store. Writes the same product rows as the
+    REST API, many products in one statement. Products are matched by eoIdentifier, which is unique in the product table.
+
+    dsn - libpq connection string of the database, e.g. "host=... dbname=oseo user=... password=..."
+    product_table - Name of the product table
+    collection_table - Name of the collection table
+    """
+
+    def __init__(self, dsn, product_table="product", collection_table="collection"):
+        if psycopg2 is None:
+            raise RuntimeError("The bulk mode needs psycopg2, install it with pip install psycopg2-binary")
+        self.dsn = dsn
+        self.product_table = product_table
+        self.collection_table = collection_table
+        self._connection = psycopg2.connect(dsn)
+        self._collection_ids = {}
+
+    def _collection_id(self, cursor, collection_id):
+        if collection_id not in self._collection_ids:
+            cursor.execute(f'SELECT id FROM {self.collection_table} WHERE "eoIdentifier" = %s', (collection_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise KeyError(f"Collection {collection_id} is not in the database")
+            self._collection_ids[collection_id] = row[0]
+        return self._collection_ids[collection_id]
+
+    def _row(self, collection_key, product):
+        properties = product["properties"]
+        values = [
+            psycopg2.extras.Json(properties.get(key)) if column in JSON_COLUMNS else properties.get(key)
+            for key, column in PRODUCT_COLUMNS.items()
+        ]
+        return (*values, psycopg2.extras.Json(product["geometry"]), collection_key)
+
+    def write(self, collection_id, products, deletes=()):
+        """
+        Inserts or updates the products and deletes the product ids in one transaction.
+
+        collection_id - Id of the collection of the products
+        products - List of converted products
+        deletes - List of product ids to delete
+        """
+
+        columns = ", ".join(f'"{column}"' for column in PRODUCT_COLUMNS.values())
+        updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in list(PRODUCT_COLUMNS.values())[1:])
+
+        # A dropped connection is closed by psycopg2 when a statement fails on it, the retry of the batch reconnects
+        if self._connection.closed:
+            self._connection = psycopg2.connect(self.dsn)
+
+        try:
+            with self._connection.cursor() as cursor:
+                collection_key = self._collection_id(cursor, collection_id)
+                if products:
+                    psycopg2.extras.execute_values(
+                        cursor,
+                        f'INSERT INTO {self.product_table} ({columns}, "footprint", "collection_id") VALUES %s '
+                        f'ON CONFLICT ("eoIdentifier") DO UPDATE SET {updates}, "footprint" = EXCLUDED."footprint"',
+                        [self._row(collection_key, product) for product in products],
+                        template=f"({', '.join(['%s'] * len(PRODUCT_COLUMNS))}, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326), %s)",
+                        page_size=len(products)
+                    )
+                if deletes:
+                    cursor.execute(
+                        f'DELETE FROM {self.product_table} WHERE "eoIdentifier" = ANY(%s) AND "collection_id" = %s',
+                        (list(deletes), collection_key)
+                    )
+            self._connection.commit()
+        except Exception:
+            # Rolling back a lost connection fails as well, the original error is the one raised
+            if not self._connection.closed:
+                try:
+                    self._connection.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+
+    def close(self):
+        self._connection.close()
+
+class BulkProductWriter:
+
+    """
+    Product writer with the interface of GeoServerWriter that collects the product writes into batches and writes
+    each batch to the OSEO database in one transaction. If a batch fails, its products are written one by one,
+    so every product still gets its own WriteResult. Collection level requests go to the REST API through writer.
+    The number of batches waiting for the database is bounded: the product write that fills a batch blocks while
+    queued_batches batches are already waiting, so products do not pile up when the database is slower than the sync.
+
+    writer - GeoServerWriter for the collection level requests
+    database - ProductDatabase
+    batch_size - Number of products written in one transaction
+    on_result - Optional function called with every WriteResult as the writes complete
+    retrier - Optional Retrier for the batch writes
+    queued_batches - Number of full batches waiting or being written at the same time
+    """
+
+    def __init__(self, writer, database, batch_size=DEFAULT_BATCH_SIZE, on_result=None, retrier=None, queued_batches=DEFAULT_QUEUED_BATCHES):
+        self.writer = writer
+        self.database = database
+        self.batch_size = max(1, int(batch_size))
+        self.on_result = on_result
+        self.retrier = retrier
+
+        # One database connection, so the batches are written one after another while the next one is collected
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queued = threading.BoundedSemaphore(max(1, int(queued_batches)))
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._results = []
+        self._pending = []
+
+    def request(self, method, request_point, json=None):
+        return self.writer.request(method, request_point, json=json)
+
+    def _add(self, collection_id, method, product_id, product, key):
+        future = Future()
+        with self._lock:
+            batch = self._batches.setdefault(collection_id, [])
+            batch.append((method, product_id, product, key, future))
+            full = self._batches.pop(collection_id) if len(batch) >= self.batch_size else None
+        if full:
+            self._submit(collection_id, full)
+        return future
+
+    def _submit(self, collection_id, batch):
+        # Called without the lock, which the batch writes need to report their results
+        self._queued.acquire()
+        future = self._executor.submit(self._write_batch, collection_id, batch)
+        future.add_done_callback(lambda future: self._queued.release())
+        with self._lock:
+            self._pending.append(future)
+
+    def _wait_for_batch_slot(self):
+        self._queued.acquire()
+        self._queued.release()
+
+    async def ready(self):
+        """
+        Waits until a full batch could be queued without blocking. Awaited on an event loop before a product write,
+        so the loop is not blocked in the write, see AsyncGeoServerWriter.ready.
+        """
+
+        if self._queued.acquire(blocking=False):
+            self._queued.release()
+            return
+        await asyncio.to_thread(self._wait_for_batch_slot)
+
+    def _write(self, collection_id, batch):
+        products = [product for method, _, product, _, _ in batch if method != "DELETE"]
+        deletes = [product_id for method, product_id, _, _, _ in batch if method == "DELETE"]
+        with metrics.timer("db_batch"):
+            if self.retrier:
+                self.retrier.call("upload", f"{len(batch)} products of {collection_id}", self.database.write, collection_id, products, deletes)
+            else:
+                self.database.write(collection_id, products, deletes)
+        metrics.count("products", len(batch), stage="db")
+
+    def _write_batch(self, collection_id, batch):
+        url = f"db:{self.database.product_table}/{collection_id}"
+        try:
+            self._write(collection_id, batch)
+            errors = [None] * len(batch)
+        except Exception:
+            # Find the products that fail by writing them one by one
+            errors = []
+            for write in batch:
+                try:
+                    self._write(collection_id, [write])
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(str(e))
+
+        for (method, product_id, _, key, future), error in zip(batch, errors):
+            result = WriteResult(key or product_id, method, url, None, error)
+            with self._lock:
+                self._results.append(result)
+            if self.on_result:
+                self.on_result(result)
+            future.set_result(result)
+
+    def post_product(self, collection_id, product, key=None):
+        return self._add(collection_id, "POST", product["properties"]["eop:identifier"], product, key)
+
+    def put_product(self, collection_id, product_id, product, key=None):
+        return self._add(collection_id, "PUT", product_id, product, key)
+
+    def delete_product(self, collection_id, product_id, key=None):
+        return self._add(collection_id, "DELETE", product_id, None, key)
+
+    def drain(self):
+        """
+        Writes the incomplete batches, waits for all batches and returns their WriteResults.
+        """
+
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        for collection_id, batch in batches.items():
+            self._submit(collection_id, batch)
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        self.drain()
+        self._executor.shutdown(wait=True)
+        self.database.close()
+        self.writer.close()
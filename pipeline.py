@@ -0,0 +1,126 @@
+import queue
+import threading
+import metrics
+
+DEFAULT_QUEUE_SIZE = 256
+
+_DONE = object()
+
+class Stage:
+
+    """
+    One step of a Pipeline. Every worker thread of the stage takes values from the input queue, calls function on them
+    and puts the results to the output queue. A result of None drops the value.
+
+    name - Name of the stage, used in error reports and as the stage of its timings in metrics
+    function - Function called for each value
+    workers - Number of threads running the stage
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, int(workers))
+
+class Pipeline:
+
+    """
+    Streaming pipeline of stages connected by bounded queues. The source is iterated in its own thread and every
+    stage runs in its own threads, so all stages work at the same time and a value reaches the sink as soon as it
+    has passed through every stage. The bounded queues keep a fast stage from running far ahead of a slow one.
+
+    stages - List of Stages in processing order
+    queue_size - Maximum number of values waiting between two stages
+    on_error - Optional function called with (stage name, value, exception) when a stage raises. The value is dropped
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, on_error=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+
+    def _feed(self, source, output, stop):
+        try:
+            for value in source:
+                if stop.is_set():
+                    # Lets a generator source clean up, e.g. shut down its pool of requests
+                    getattr(source, "close", lambda: None)()
+                    break
+                output.put(value)
+        except Exception as e:
+            if self.on_error:
+                self.on_error("source", None, e)
+            else:
+                raise
+        finally:
+            output.put(_DONE)
+
+    def _work(self, stage, input, output, remaining, lock, stop):
+        while True:
+            value = input.get()
+            if value is _DONE:
+                # Let the other workers of the stage see the end of the stream too
+                input.put(_DONE)
+                break
+            if stop.is_set():
+                # The run failed, the values are dropped until the end of the stream
+                continue
+            try:
+                with metrics.timer(stage.name):
+                    result = stage.function(value)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(stage.name, value, e)
+                else:
+                    print(f" ! {stage.name} failed: {e}")
+                continue
+            if result is not None:
+                output.put(result)
+
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            output.put(_DONE)
+
+    def run(self, source, sink=None):
+        """
+        Runs the values of source through the stages. sink is called in the calling thread with every value
+        that comes out of the last stage. Returns when all values have been processed. If sink raises, the source
+        and the stages are stopped and their threads have finished when the exception is raised.
+        """
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0], stop), daemon=True)]
+
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], remaining, lock, stop),
+                    name=f"{stage.name}",
+                    daemon=True
+                ))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                value = queues[-1].get()
+                if value is _DONE:
+                    break
+                if sink:
+                    sink(value)
+        except BaseException:
+            # No thread may stay blocked on a full queue: the stages drop what is left and the last queue is drained
+            stop.set()
+            while queues[-1].get() is not _DONE:
+                pass
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,163 @@
+import cProfile
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+# Seconds between two samples of the thread stacks
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+# Number of frames kept for every memory allocation
+TRACEMALLOC_FRAMES = 25
+
+class StackSampler(threading.Thread):
+
+    """
+    Wall-clock sampling profiler. Takes the stack of every thread at a fixed interval and counts the stacks,
+    so the time threads spend waiting on the network or on locks shows up as well as the time they compute.
+    The stacks are written in the collapsed format of flamegraph.pl (also read by speedscope and inferno),
+    with the name of the thread as the root frame.
+
+    interval - Seconds between two samples
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            # Threads of the same pool get the same root, e.g. ThreadPoolExecutor-0_3 -> ThreadPoolExecutor
+            thread = re.sub(r"[-_]\d+(_\d+)?$", "", names.get(ident, "thread"))
+            self.stacks[";".join([thread, *reversed(stack)])] += 1
+        self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class ThreadProfiler:
+
+    """
+    cProfile of every thread. Before Python 3.12 cProfile only sees the thread that enabled it, so every thread
+    started while profiling gets a profiler of its own and the results are added together. Threads that were
+    already running before the start are only seen by the StackSampler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profiles = []
+
+    def _start_thread(self, *args):
+        # Called on the first profiling event of a new thread, enabling the profiler replaces this hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        self.profiles = [cProfile.Profile()]
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+        self.profiles[0].enable()
+
+    def stop(self):
+        self.profiles[0].disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+
+    def stats(self):
+        with self._lock:
+            return pstats.Stats(*self.profiles)
+
+def _write_stats(stats, path):
+    with open(path, "w") as f:
+        stats.stream = f
+        for order in ("cumulative", "tottime"):
+            f.write(f"Top 50 functions by {order} time\n")
+            stats.sort_stats(order).print_stats(50)
+
+def _write_memory(first, last, peak, path):
+    with open(path, "w") as f:
+        f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB\n\n")
+        f.write("Top 30 allocation sites by memory still allocated at the end\n")
+        for statistic in last.statistics("lineno")[:30]:
+            f.write(f"{statistic}\n")
+        f.write("\nTop 30 allocation sites by growth during the run\n")
+        for statistic in last.compare_to(first, "lineno")[:30]:
+            f.write(f"{statistic}\n")
+
+@contextmanager
+def profile(directory, name, interval=DEFAULT_SAMPLE_INTERVAL):
+    """
+    Context manager that profiles the code run inside it and writes into directory:
+    name.prof - cProfile statistics of all threads, to be opened with pstats or snakeviz
+    name.txt - The 50 functions with the most cumulative and own time
+    name.collapsed - Sampled stacks of all threads in the collapsed flame graph format, e.g. flamegraph.pl name.collapsed > name.svg
+    name.memory.txt - tracemalloc peak, the largest allocation sites at the end and their growth during the run
+    name.tracemalloc - tracemalloc snapshot at the end, to be loaded with tracemalloc.Snapshot.load
+
+    directory - Folder of the profile files
+    name - Base name of the files, e.g. the id of the collection being profiled
+    interval - Seconds between two stack samples
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = re.sub(r"[^\w.-]", "_", name)
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    first = tracemalloc.take_snapshot()
+
+    profiler = ThreadProfiler()
+    sampler = StackSampler(interval)
+    start = time.perf_counter()
+    profiler.start()
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        profiler.stop()
+        seconds = time.perf_counter() - start
+
+        last = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+        stats = profiler.stats()
+        stats.dump_stats(directory / f"{name}.prof")
+        _write_stats(stats, directory / f"{name}.txt")
+        sampler.write(directory / f"{name}.collapsed")
+        _write_memory(first, last, peak, directory / f"{name}.memory.txt")
+        last.dump(str(directory / f"{name}.tracemalloc"))
+        print(f"Profile of {name} ({seconds:.1f} s, {sampler.samples} stack samples) written to {directory}")
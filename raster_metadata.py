@@ -0,0 +1,143 @@
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+import requests
+import rasterio
+import rate_limit
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / ".cache"
+
+# GDAL configuration for reading only the header of a remote COG:
+# no sidecar file lookups, a single small range request at open and no per-dataset block cache
+GDAL_HEADER_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF,.TIFF",
+    "GDAL_INGESTED_BYTES_AT_OPEN": "16384",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "VSI_CACHE": "FALSE",
+}
+
+class RasterMetadataCache:
+
+    """
+    On-disk store of raster metadata. Entries are keyed by the asset href and validated with
+    the ETag/Last-Modified of the asset, so unchanged rasters are never opened again.
+
+    path - Path of the SQLite file holding the cache
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=60)
+        # Every put commits, WAL with synchronous=NORMAL keeps the commits from waiting on an fsync each
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS raster_metadata (href TEXT PRIMARY KEY, validator TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    def __reduce__(self):
+        # A worker process opens its own connection to the same cache
+        return (RasterMetadataCache, (self.path,))
+
+    def get(self, href, validator):
+        if validator is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT metadata FROM raster_metadata WHERE href = ? AND validator = ?", (href, validator)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, href, validator, metadata):
+        if validator is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO raster_metadata (href, validator, metadata) VALUES (?, ?, ?)",
+                (href, validator, json.dumps(metadata))
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def asset_validator(href):
+    """
+    Returns a string identifying the current version of the asset, or None if the source gives no way to tell.
+    Remote assets use the ETag or Last-Modified header of a HEAD request, local files their size and modification time.
+    """
+
+    if href.startswith(("http://", "https://")):
+        # A host that refuses HEAD requests, or a HEAD that fails, gives no way to tell: the raster is read without the cache
+        try:
+            with rate_limit.slot(href):
+                r = requests.head(href, allow_redirects=True, timeout=30)
+                r.raise_for_status()
+        except requests.RequestException:
+            return None
+        if r.headers.get("ETag"):
+            return f"etag:{r.headers['ETag']}"
+        if r.headers.get("Last-Modified"):
+            return f"last-modified:{r.headers['Last-Modified']}"
+        return None
+    try:
+        stat = os.stat(href)
+    except OSError:
+        return None
+    return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+
+def read_raster_metadata(href):
+    """
+    Opens the raster header and returns the item fields that are taken from it: gsd, proj:epsg and proj:transform.
+    """
+
+    with rate_limit.slot(href), rasterio.Env(**GDAL_HEADER_OPTIONS):
+        with rasterio.open(href) as src:
+            epsg = src.crs.to_epsg()
+            return {
+                "gsd": src.res[0],
+                # 9391 EPSG code is false, replace by the standard 3067
+                "proj:epsg": 3067 if epsg == 9391 else epsg,
+                "proj:transform": [
+                    src.transform.a,
+                    src.transform.b,
+                    src.transform.c,
+                    src.transform.d,
+                    src.transform.e,
+                    src.transform.f,
+                    src.transform.g,
+                    src.transform.h,
+                    src.transform.i
+                ]
+            }
+
+def cached_raster_metadata(href, cache=None):
+    """
+    Returns the raster metadata of href from the cache if the asset has not changed since it was cached,
+    otherwise reads the raster header and stores the result.
+    """
+
+    if cache is None:
+        return read_raster_metadata(href)
+
+    validator = asset_validator(href)
+    metadata = cache.get(href, validator)
+    if metadata is None:
+        metadata = read_raster_metadata(href)
+        cache.put(href, validator, metadata)
+    return metadata
+
+def item_raster_href(item):
+    """
+    Returns the href of the asset that is used for the raster metadata of the item, the first asset.
+    """
+
+    return next(iter(item.assets.values())).href
@@ -0,0 +1,320 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+from urllib.parse import urlparse
+from retry import classify, PERMANENT
+import metrics
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 32
+
+# Share of the concurrency kept after a host is seen to be overloaded
+DEFAULT_BACKOFF = 0.5
+
+class TokenBucket:
+
+    """
+    Caps the request rate: every request takes a token, tokens are added at rate per second up to burst.
+
+    rate - Requests per second
+    burst - Number of requests that may be sent at once after an idle period, rate if not given
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst or rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        # Takes a token and returns 0, or returns the seconds until the next token
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while wait := self._take():
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while wait := self._take():
+            await asyncio.sleep(wait)
+
+class AdaptiveLimiter:
+
+    """
+    Concurrency limit of one host that adapts to how the host copes (additive increase, multiplicative decrease).
+    Every successful request that found the limit reached raises it by 1/limit, so by about one per round of
+    requests. Requests that were held back by something else (e.g. a smaller pool of workers) leave it as it is,
+    so the limit does not climb to maximum while the host sees little load. A request that is
+    throttled (429), fails with a server error or a timeout, or takes longer than latency_target cuts the limit
+    by backoff, at most once per round trip, as the requests in flight at the same time fail for the same reason.
+
+    initial - Concurrency at the start
+    minimum - Lowest concurrency
+    maximum - Highest concurrency
+    latency_target - Optional seconds, slower responses count as a sign of overload
+    rate - Optional cap of requests per second, see TokenBucket
+    backoff - Share of the limit kept after an overload
+    name - Name of the limiter in the metrics, the host
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, minimum=1, maximum=DEFAULT_MAX_CONCURRENCY, latency_target=None, rate=None, backoff=DEFAULT_BACKOFF, name=None):
+        self.name = name
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.initial = self.limit
+        self.latency_target = latency_target
+        self.bucket = TokenBucket(rate) if rate else None
+        self.backoff = backoff
+        self.in_flight = 0
+        self.requests = 0
+        self.decreases = 0
+        self.lowest = self.highest = self.limit
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # (loop, future) of the coroutines waiting for a slot, woken from release on their own loop
+        self._async_waiters = deque()
+
+    def acquire(self):
+        """
+        Waits for a free slot and a token. Returns True if the request takes the last free slot, i.e. the limit is what holds the requests back.
+        """
+
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            saturated = self.in_flight >= int(self.limit)
+        if self.bucket:
+            self.bucket.acquire()
+        return saturated
+
+    async def acquire_async(self):
+        """
+        Same as acquire for a coroutine. The event loop must not block on the condition, so a coroutine that finds
+        no free slot waits on a future that release completes.
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    saturated = self.in_flight >= int(self.limit)
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    else:
+                        # The wake-up was meant for this coroutine, it is passed on to the next one
+                        self._wake_async_waiters()
+                raise
+        if self.bucket:
+            await self.bucket.acquire_async()
+        return saturated
+
+    def _wake_async_waiters(self):
+        # Called with the lock held: wakes as many waiting coroutines as there are free slots
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The loop of the waiter is closed
+                continue
+            free -= 1
+
+    def release(self, seconds, overloaded=False, saturated=True):
+        with self._condition:
+            self.in_flight -= 1
+            self.requests += 1
+            now = time.monotonic()
+            if overloaded or (self.latency_target and seconds > self.latency_target):
+                if now - self._last_decrease > seconds:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+                    metrics.count("limit_decreases", stage=self.name)
+            elif saturated:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.lowest = min(self.lowest, self.limit)
+            self.highest = max(self.highest, self.limit)
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+    @contextmanager
+    def slot(self):
+        """
+        Context manager around one request: waits for a free slot and a token, and adapts the limit to the outcome.
+        """
+
+        saturated = self.acquire()
+        start = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = classify(e) != PERMANENT
+            raise
+        finally:
+            self.release(time.perf_counter() - start, overloaded, saturated)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """
+        Same as slot for a request made in a coroutine.
+        """
+
+        saturated = await self.acquire_async()
+        start = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = classify(e) != PERMANENT
+            raise
+        finally:
+            self.release(time.perf_counter() - start, overloaded, saturated)
+
+def _wake(waiter):
+    # Runs on the loop of the waiter, which may have been cancelled in the meantime
+    if not waiter.done():
+        waiter.set_result(None)
+
+class HostLimiters:
+
+    """
+    An AdaptiveLimiter per host, e.g. one for the FMI catalog, one for the raster host and one for GeoServer.
+    Hosts without a limit of their own start at initial.
+
+    initial - Starting concurrency of the hosts not in limits
+    maximum - Highest concurrency of every host
+    limits - Dictionary of host to its starting concurrency
+    rates - Dictionary of host to its cap of requests per second
+    latency_target - Optional seconds, slower responses make the limit of the host go down
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, maximum=DEFAULT_MAX_CONCURRENCY, limits=None, rates=None, latency_target=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.limits = dict(limits or {})
+        self.rates = dict(rates or {})
+        self.latency_target = latency_target
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # A worker process starts with fresh limits of its own
+        return (HostLimiters, (self.initial, self.maximum, self.limits, self.rates, self.latency_target))
+
+    def share(self, parts):
+        """
+        Returns new HostLimiters with the concurrency and the rates divided between parts worker processes.
+        """
+
+        parts = max(1, parts)
+        return HostLimiters(
+            max(1, self.initial // parts),
+            max(1, self.maximum // parts),
+            {host: max(1, limit // parts) for host, limit in self.limits.items()},
+            {host: rate / parts for host, rate in self.rates.items()},
+            self.latency_target
+        )
+
+    def limiter(self, url):
+        """
+        Returns the AdaptiveLimiter of the host of url, or None for local paths.
+        """
+
+        host = urlparse(url).netloc
+        if not host:
+            return None
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = AdaptiveLimiter(
+                    self.limits.get(host, self.initial),
+                    maximum=max(self.maximum, self.limits.get(host, 0)),
+                    latency_target=self.latency_target,
+                    rate=self.rates.get(host),
+                    name=host
+                )
+            return self._hosts[host]
+
+    def summary(self):
+        with self._lock:
+            hosts = dict(self._hosts)
+        lines = []
+        for host, limiter in sorted(hosts.items()):
+            lines.append(
+                f"{host}: {limiter.requests} requests, concurrency {limiter.limit:.1f} at the end "
+                f"({limiter.initial:.0f} at the start, between {limiter.lowest:.1f} and {limiter.highest:.1f}), {limiter.decreases} decreases"
+            )
+        return "\n".join(lines)
+
+def parse_host_values(values, convert=float):
+    """
+    Returns a dictionary of host to value from a list of "host=value" strings, as given on the command line.
+    """
+
+    parsed = {}
+    for value in values or []:
+        host, _, number = value.rpartition("=")
+        parsed[urlparse(host).netloc or host] = convert(number)
+    return parsed
+
+def from_args(adaptive=False, host_limits=(), host_rates=(), latency_target=None):
+    """
+    Returns the HostLimiters set on the command line, or None if the requests are not limited.
+
+    adaptive - Adapt the concurrency of every host
+    host_limits - List of "host=concurrency" strings, the starting concurrency of the hosts
+    host_rates - List of "host=requests per second" strings, the rate caps of the hosts
+    latency_target - Optional seconds, slower responses make the limit of a host go down
+    """
+
+    if not (adaptive or host_limits or host_rates):
+        return None
+    return HostLimiters(limits=parse_host_values(host_limits, int), rates=parse_host_values(host_rates), latency_target=latency_target)
+
+# The limiters of this process, None if the requests are not limited
+LIMITERS = None
+
+def install(limiters):
+    """
+    Makes limiters the limiters of the HTTP fetches, raster reads and GeoServer writes of this process.
+    """
+
+    global LIMITERS
+    LIMITERS = limiters
+
+def slot(url):
+    """
+    Context manager around one request to url, limited by the installed limiters if there are any.
+    """
+
+    limiter = LIMITERS.limiter(url) if LIMITERS else None
+    return limiter.slot() if limiter else nullcontext()
+
+def slot_async(url):
+    """
+    Async context manager around one request to url made in a coroutine, see slot.
+    """
+
+    limiter = LIMITERS.limiter(url) if LIMITERS else None
+    return limiter.slot_async() if limiter else nullcontext()
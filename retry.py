@@ -0,0 +1,212 @@
+import json
+import time
+import asyncio
+import random
+import socket
+import threading
+from collections import namedtuple
+from urllib.error import HTTPError, URLError
+import requests
+import metrics
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BUDGET = 1000
+
+# Failure classes
+TRANSIENT = "transient"   # timeouts, dropped connections, 5xx: retried with backoff
+THROTTLED = "throttled"   # 429: retried with a longer backoff, honouring Retry-After
+PERMANENT = "permanent"   # 404 and other 4xx, parse errors: not retried
+
+class RetryPolicy:
+
+    """
+    How a class of failures is retried. The delay before attempt n+1 is drawn uniformly from
+    [0, min(max_delay, base_delay * 2**(n-1))] ("full jitter"), so that workers that failed together do not retry together.
+
+    max_attempts - Total number of attempts including the first one. 1 means no retries
+    base_delay - Upper bound of the first delay in seconds
+    max_delay - Upper bound of any delay in seconds
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+def default_policies(max_attempts=DEFAULT_MAX_ATTEMPTS):
+    return {
+        TRANSIENT: RetryPolicy(max_attempts, base_delay=1.0, max_delay=60.0),
+        THROTTLED: RetryPolicy(max_attempts + 3, base_delay=5.0, max_delay=120.0),
+        PERMANENT: RetryPolicy(1),
+    }
+
+def _status_code(error):
+    # The HTTP status of the error or of any error in its cause chain
+    while error is not None:
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code
+        if isinstance(error, HTTPError):
+            return error.code
+        # httpx.HTTPStatusError of the async mode
+        if type(error).__name__ == "HTTPStatusError" and isinstance(getattr(error.response, "status_code", None), int):
+            return error.response.status_code
+        error = error.__cause__ or error.__context__
+    return None
+
+def classify(error):
+    """
+    Returns the failure class of an exception: TRANSIENT, THROTTLED or PERMANENT.
+    """
+
+    status = _status_code(error)
+    if status is not None:
+        if status == 429:
+            return THROTTLED
+        if status >= 500 or status == 408:
+            return TRANSIENT
+        if status >= 400:
+            return PERMANENT
+
+    # Database errors carry their SQLSTATE: connection, transaction rollback (deadlocks), resource and shutdown errors can be retried
+    pgcode = getattr(error, "pgcode", None)
+    if pgcode:
+        return TRANSIENT if pgcode[:2] in ("08", "40", "53", "57") else PERMANENT
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, socket.timeout, ConnectionError, TimeoutError, URLError)):
+        return TRANSIENT
+    if isinstance(error, (ValueError, KeyError, TypeError)):
+        # json.JSONDecodeError is a ValueError, so are pystac's STAC validation errors
+        return PERMANENT
+
+    # GDAL reports HTTP errors of remote rasters only in the message
+    message = str(error)
+    if "HTTP response code: 4" in message and "HTTP response code: 429" not in message:
+        return PERMANENT
+    return TRANSIENT
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+DeadLetter = namedtuple("DeadLetter", ["kind", "target", "failure", "error", "attempts"])
+
+class Retrier:
+
+    """
+    Runs network calls with retries. Every failure is classified and retried according to the policy of its class.
+    All retries of a run draw from one budget, so a broken endpoint cannot keep the run retrying forever.
+    Calls that still fail are recorded as dead letters and the last error is raised.
+
+    policies - Dictionary of failure class to RetryPolicy, see default_policies
+    budget - Total number of retries allowed for the run
+    """
+
+    def __init__(self, policies=None, budget=DEFAULT_RETRY_BUDGET):
+        self.policies = policies or default_policies()
+        self.budget = budget
+        self.retries = 0
+        self.dead_letters = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def share(self, parts):
+        """
+        Returns a new Retrier with the same policies and an equal share of the remaining budget, for a worker process.
+        """
+
+        return Retrier(self.policies, budget=max(0, self.budget - self.retries) // max(1, parts))
+
+    def merge(self, dead_letters, retries):
+        """
+        Adds the dead letters and the number of retries of a worker process to this Retrier.
+        """
+
+        with self._lock:
+            self.dead_letters.extend(DeadLetter(*letter) for letter in dead_letters)
+            self.retries += retries
+
+    def _take_retry(self):
+        with self._lock:
+            if self.retries >= self.budget:
+                return False
+            self.retries += 1
+            return True
+
+    def _retry_delay(self, kind, target, error, attempt):
+        # Returns the seconds to wait before the next attempt, or None if the failure may not be retried any more
+        failure = classify(error)
+        policy = self.policies[failure]
+        if attempt >= policy.max_attempts or not self._take_retry():
+            with self._lock:
+                self.dead_letters.append(DeadLetter(kind, target, failure, str(error), attempt))
+            metrics.count("dead_letters", stage=kind)
+            return None
+        metrics.count("retries", stage=kind)
+        delay = policy.delay(attempt)
+        if failure == THROTTLED:
+            delay = max(delay, _retry_after(error) or 0)
+        print(f" ! {kind} {target} failed ({error}), retrying in {delay:.1f} s")
+        return delay
+
+    def call(self, kind, target, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs) until it succeeds or its failure may not be retried any more.
+
+        kind - What is being done, e.g. "item", "collection", "raster" or "upload". Used in the dead letter report
+        target - The URL or id the call is about
+        """
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(kind, target, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def call_async(self, kind, target, function, *args, **kwargs):
+        """
+        Same as call for a coroutine function, waits with asyncio.sleep between the attempts.
+        """
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(kind, target, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def report(self, path=None):
+        """
+        Prints a summary of the retries and the skipped calls, and writes the dead letters to path as JSON if given.
+        """
+
+        print(f"Retries used: {self.retries}/{self.budget}, skipped after failures: {len(self.dead_letters)}")
+        for letter in self.dead_letters:
+            print(f" ! Skipped {letter.kind} {letter.target} after {letter.attempts} attempts: {letter.error}")
+        if path and self.dead_letters:
+            with open(path, "w") as f:
+                json.dump([letter._asdict() for letter in self.dead_letters], f, indent=2)
@@ -0,0 +1,117 @@
+import json
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import http_cache
+import metrics
+import profiling
+import rate_limit
+
+class CollectionSizes:
+
+    """
+    Number of items per collection seen by the previous run, used to start the largest collections first.
+
+    path - Path of the JSON file holding the sizes
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(self.path) as f:
+                self.sizes = json.load(f)
+        except FileNotFoundError:
+            self.sizes = {}
+
+    def order(self, keys):
+        """
+        Returns the keys with the largest collections first. Collections without a size from a previous run come first,
+        as nothing is known about how long they take.
+        """
+
+        return sorted(keys, key=lambda key: -self.sizes.get(key, float("inf")))
+
+    def update(self, key, size):
+        self.sizes[key] = size
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.sizes, f, indent=2)
+
+def _init_worker(fmi_client, limiters):
+    # pystac's default StacIO is per process, the worker reads the FMI catalog through its own copy of the client
+    if fmi_client is not None:
+        http_cache.install(fmi_client)
+    rate_limit.install(limiters)
+
+def _call(function, args, kwargs, key, profile):
+    if profile and profile[0] == key:
+        with profiling.profile(profile[1], profile[2]):
+            return function(*args, **kwargs)
+    return function(*args, **kwargs)
+
+def _run_job(function, args, kwargs, key=None, profile=None):
+    # The worker starts every job with empty metrics, so that each job reports only its own
+    metrics.METRICS.reset()
+    result = _call(function, args, kwargs, key, profile)
+    retrier = kwargs.get("retrier")
+    if retrier is None:
+        return result, [], 0, metrics.METRICS.snapshot()
+    return result, retrier.dead_letters, retrier.retries, metrics.METRICS.snapshot()
+
+def run_collections(function, jobs, processes=1, sizes=None, retrier=None, fmi_client=None, profile=None, **kwargs):
+    """
+    Runs function once per collection. With more than one process the collections are handed to a pool of
+    worker processes, the largest collections (by the sizes of the previous run) first.
+    Returns a dictionary of job key to the result of the function, or to the exception it raised.
+
+    function - Top-level function called as function(*args, **kwargs, retrier=...)
+    jobs - Dictionary of job key to the tuple of positional arguments of the job
+    processes - Number of worker processes. 1 runs the jobs one after another in this process
+    sizes - Optional CollectionSizes used to order the jobs
+    retrier - Retrier passed to the jobs. Each job in a worker process gets an equal share of the remaining retry budget,
+              and the retries and dead letters of the jobs are added to this retrier.
+              The metrics of the jobs in worker processes are added to the metrics of this process
+    fmi_client - CachedHttpClient that the worker processes read the FMI catalog through
+    profile - Optional (key, directory, name): the job with this key is profiled and the profile is written to directory
+              under name, see profiling.profile
+    kwargs - Keyword arguments passed to every job
+    """
+
+    keys = sizes.order(jobs) if sizes else list(jobs)
+    results = {}
+
+    if processes <= 1:
+        for key in keys:
+            try:
+                results[key] = _call(function, jobs[key], {"retrier": retrier, **kwargs}, key, profile)
+            except Exception as e:
+                print(f"ERROR {e} in {key}")
+                results[key] = e
+        return results
+
+    worker_retrier = retrier.share(len(keys)) if retrier else None
+
+    # The workers share the concurrency and the rates of each host
+    worker_limiters = rate_limit.LIMITERS.share(processes) if rate_limit.LIMITERS else None
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(fmi_client, worker_limiters)) as executor:
+        futures = {
+            executor.submit(_run_job, function, jobs[key], {"retrier": worker_retrier, **kwargs}, key, profile): key
+            for key in keys
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                result, dead_letters, retries, worker_metrics = future.result()
+            except Exception as e:
+                print(f"ERROR {e} in {key}")
+                results[key] = e
+                continue
+            if retrier:
+                retrier.merge(dead_letters, retries)
+            metrics.METRICS.merge(worker_metrics)
+            results[key] = result
+
+    return results
@@ -0,0 +1,35 @@
+import warnings
+from pystac_client.warnings import DoesNotConformTo
+
+DEFAULT_PAGE_SIZE = 1000
+
+def list_item_ids(client, collection_id, page_size=DEFAULT_PAGE_SIZE, with_updated=False):
+    """
+    Function to list the ids of the items of a collection in a STAC API without building pystac Items.
+    Uses the item search with large pages and the fields extension, so that the API only returns the ids
+    (and the updated timestamps if requested). If the API ignores the fields extension, the ids are taken from the full items.
+
+    client - pystac_client Client of the STAC API
+    collection_id - Id of the collection
+    page_size - Number of items requested per page
+    with_updated - If True, returns a dictionary of item id to its "updated" property (None if not set) instead of a set of ids
+    """
+
+    fields = ["id", "properties.updated"] if with_updated else ["id"]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DoesNotConformTo)
+        search = client.search(collections=[collection_id], limit=page_size, fields=fields)
+        pages = search.pages_as_dicts()
+
+        if with_updated:
+            item_ids = {}
+            for page in pages:
+                for feature in page.get("features", []):
+                    item_ids[feature["id"]] = feature.get("properties", {}).get("updated")
+        else:
+            item_ids = set()
+            for page in pages:
+                item_ids.update(feature["id"] for feature in page.get("features", []))
+
+    return item_ids
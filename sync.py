@@ -0,0 +1,128 @@
+import json
+import hashlib
+from pathlib import Path
+import json_backend
+
+# Largest share of the products of a collection that a sync may delete
+DEFAULT_MAX_DELETE_PERCENT = 10
+
+def content_hash(content):
+    """
+    Returns a SHA-256 hash of a JSON dictionary that does not depend on the key order.
+    """
+
+    return hashlib.sha256(json_backend.dumps(content, sort_keys=True)).hexdigest()
+
+class SyncManifest:
+
+    """
+    Record of the items of one collection as they were at the last successful sync.
+    For every item id the manifest holds the hash of the FMI item ("source") and the hash of the
+    converted GeoServer product ("converted"). The converted hash is None for items that were already
+    in the CSC catalog when the manifest was started.
+
+    path - Path of the JSON file of the manifest
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = Path(path)
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                return cls(path, json.load(f))
+        except FileNotFoundError:
+            return cls(path)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        tmp_path.replace(self.path)
+
+    def source_hash(self, item_id):
+        return self.entries.get(item_id, {}).get("source")
+
+    def converted_hash(self, item_id):
+        return self.entries.get(item_id, {}).get("converted")
+
+    def record(self, item_id, source_hash, converted_hash):
+        self.entries[item_id] = {"source": source_hash, "converted": converted_hash}
+
+    def remove(self, item_id):
+        self.entries.pop(item_id, None)
+
+class SyncPlan:
+
+    """
+    The sets of item ids that a sync has to act on.
+
+    add - Items that are in FMI but not in the CSC catalog, POSTed
+    update - Items that changed in FMI since the last sync. These are converted and PUT unless the product turns out identical
+    delete - Products in the CSC catalog whose item is no longer in FMI, DELETEd
+    unchanged - Items that are skipped, no raster read and no upload
+    """
+
+    def __init__(self):
+        self.add = set()
+        self.update = set()
+        self.delete = set()
+        self.unchanged = set()
+
+    def resolve(self, item_id, converted_hash, manifest):
+        """
+        Called for an updated item once it has been converted. Moves the item to unchanged if the converted product
+        is identical to the one uploaded at the last sync. Returns True if the product has to be written.
+        """
+
+        if item_id in self.update and converted_hash == manifest.converted_hash(item_id):
+            self.update.discard(item_id)
+            self.unchanged.add(item_id)
+            return False
+        return True
+
+    def summary(self):
+        return f"{len(self.add)} to add, {len(self.update)} to update, {len(self.delete)} to delete, {len(self.unchanged)} unchanged"
+
+    def classify(self, item_id, source_hash, manifest, csc_item_ids):
+        """
+        Puts one FMI item in add, update or unchanged and returns the name of the set.
+        Lets the plan be built while the items are still being fetched.
+        """
+
+        if item_id not in csc_item_ids:
+            self.add.add(item_id)
+            return "add"
+        elif item_id not in manifest.entries:
+            # Already uploaded before there was a manifest, taken as the baseline
+            self.unchanged.add(item_id)
+            return "unchanged"
+        elif manifest.source_hash(item_id) != source_hash:
+            self.update.add(item_id)
+            return "update"
+        self.unchanged.add(item_id)
+        return "unchanged"
+
+    def finish(self, fmi_item_ids, manifest, csc_item_ids):
+        """
+        Fills the delete set once all FMI items are known: products in the CSC catalog whose item is no longer in FMI,
+        whether or not they were uploaded by a sync with a manifest.
+        """
+
+        for item_id in csc_item_ids:
+            if item_id not in fmi_item_ids:
+                self.delete.add(item_id)
+
+    def check_deletes(self, csc_item_ids, max_delete_percent=DEFAULT_MAX_DELETE_PERCENT):
+        """
+        Safety check against deleting most of a collection because of a problem on the FMI side.
+        Empties the delete set and returns False if it would delete more than max_delete_percent of the products.
+        """
+
+        if csc_item_ids and len(self.delete) > len(csc_item_ids) * max_delete_percent / 100:
+            self.delete.clear()
+            return False
+        return True
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules of the repository are imported from its root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,81 @@
+import copy
+import pytest
+from pystac import Collection, Extent, SpatialExtent, TemporalExtent
+from update_fmi import check_conversion, convert_item_dict
+
+RASTER_METADATA = {"gsd": 10.0, "proj:epsg": 3067, "proj:transform": [10.0, 0.0, 300000.0, 0.0, -10.0, 7000000.0, 0.0, 0.0, 1.0]}
+
+def fmi_collection():
+    return Collection(
+        id="tuulituhohaukka_at_fmi",
+        description="Collection of the test items",
+        extent=Extent(SpatialExtent([[19.0, 59.0, 32.0, 71.0]]), TemporalExtent([[None, None]])),
+        license="CC-BY-4.0"
+    )
+
+def fmi_item(properties=None, asset=None, license="CC-BY-4.0"):
+    """
+    Item dictionary in the shape of the FMI catalog. properties and asset replace the defaults.
+    """
+
+    item = {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "id": "tuulituhohaukka_2021-06-01_2021-06-30",
+        "geometry": {"type": "Polygon", "coordinates": [[[19.0, 59.0], [32.0, 59.0], [32.0, 71.0], [19.0, 71.0], [19.0, 59.0]]]},
+        "bbox": [19.0, 59.0, 32.0, 71.0],
+        "properties": properties or {
+            "datetime": None,
+            "start_datetime": "2021-06-01T00:00:00Z",
+            "end_datetime": "2021-06-30T00:00:00Z",
+        },
+        "links": [{"rel": "license", "href": "https://creativecommons.org/licenses/by/4.0/"}],
+        "assets": {
+            "data": asset if asset is not None else {
+                "href": "https://pta.data.lit.fmi.fi/sen2/tuulituhohaukka/2021-06-01.tif",
+                "type": "image/tiff; application=geotiff; profile=cloud-optimized",
+                "title": "Wind damage",
+                "roles": ["data"],
+            }
+        },
+    }
+    if license is not None:
+        item["license"] = license
+    return item
+
+ASSETS = {
+    "roles as a list": {"href": "https://example.com/a.tif", "type": "image/tiff", "roles": ["data"]},
+    "roles as a string": {"href": "https://example.com/a.tif", "type": "image/tiff", "roles": "data"},
+    "roles missing": {"href": "https://example.com/a.tif", "type": "image/tiff"},
+    "type None": {"href": "https://example.com/a.tif", "type": None, "roles": ["data"]},
+    "title None": {"href": "https://example.com/a.tif", "type": "image/tiff", "title": None, "roles": ["data"]},
+    "description None": {"href": "https://example.com/a.tif", "type": "image/tiff", "description": None, "roles": ["data"]},
+    "type, title and description None": {"href": "https://example.com/a.tif", "type": None, "title": None, "description": None},
+}
+
+PROPERTIES = {
+    "start and end": {"datetime": None, "start_datetime": "2021-06-01T00:00:00Z", "end_datetime": "2021-06-30T00:00:00Z"},
+    "start and end with datetime": {"datetime": "2021-06-15T00:00:00Z", "start_datetime": "2021-06-01T00:00:00Z", "end_datetime": "2021-06-30T00:00:00Z"},
+    "datetime only": {"datetime": "2021-06-15T12:30:00Z", "start_datetime": None, "end_datetime": None},
+    "datetime only with fractional seconds": {"datetime": "2021-06-15T12:30:00.250000Z", "start_datetime": None, "end_datetime": None},
+}
+
+@pytest.mark.parametrize("asset", ASSETS.values(), ids=ASSETS.keys())
+def test_assets(asset):
+    assert check_conversion(fmi_item(asset=asset), fmi_collection(), RASTER_METADATA) == []
+
+@pytest.mark.parametrize("properties", PROPERTIES.values(), ids=PROPERTIES.keys())
+def test_datetimes(properties):
+    assert check_conversion(fmi_item(properties=properties), fmi_collection(), RASTER_METADATA) == []
+
+def test_datetime_only_sets_start_and_end():
+    product = convert_item_dict(fmi_item(properties=copy.deepcopy(PROPERTIES["datetime only"])), "tuulituhohaukka_at_fmi", RASTER_METADATA)
+    assert product["properties"]["timeStart"] == product["properties"]["timeEnd"] == "2021-06-15T12:30:00Z"
+
+def test_license():
+    item = fmi_item()
+    assert check_conversion(item, fmi_collection(), RASTER_METADATA) == []
+    # check_conversion works on copies, the item itself is not changed
+    assert item["license"] == "CC-BY-4.0"
+    product = convert_item_dict(copy.deepcopy(item), "tuulituhohaukka_at_fmi", RASTER_METADATA)
+    assert "license" not in product["properties"]
@@ -1,32 +1,30 @@
 import argparse
-import urllib
 import getpass
-import requests
 import pystac_client
 import pandas as pd
-import rasterio
 import time
-import json
-from urllib.parse import urljoin
-from pystac import Collection, Item
-
-def retry_errors(list_of_items, list_of_errors):
-    """
-    Function to retry retrieving the items that were timed out during the process.
-    
-    list_of_items - List containing the STAC items from the source. The errored items will be appended to this list when successfully retrieved
-    list_of_errors - List of links to the items that timed out during the retrieving process. Function will run until this list is empty
-    """
-
-    print(" * Trying to add items that timedout")
-    while len(list_of_errors) > 0:
-        for item in list_of_errors:
-            try:
-                list_of_items.append(Item.from_file(item))
-                print(f" * Listed {item}")
-                list_of_errors.remove(item)
-            except Exception as e:
-                print(f" ! {e} on {item}")
+import threading
+from pathlib import Path
+import copy
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pystac import Item, StacIO
+from pystac.utils import datetime_to_str, str_to_datetime
+from harvest import DEFAULT_WORKERS, discover_item_links
+from collection_loader import load_collection
+from raster_metadata import RasterMetadataCache, cached_raster_metadata, item_raster_href, DEFAULT_CACHE_DIR
+import http_cache
+from sync import SyncManifest, SyncPlan, content_hash, DEFAULT_MAX_DELETE_PERCENT
+from pipeline import Pipeline, Stage, DEFAULT_QUEUE_SIZE
+from stac_api import list_item_ids, DEFAULT_PAGE_SIZE
+from geoserver import GeoServerWriter, print_write_result, DEFAULT_UPLOAD_WORKERS
+from async_http import AsyncFetcher, AsyncGeoServerWriter, EventLoopThread, item_links as raw_item_links
+from checkpoint import Checkpoint
+from oseo_database import ProductDatabase, BulkProductWriter, DEFAULT_BATCH_SIZE
+from retry import Retrier, default_policies, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BUDGET
+from scheduler import CollectionSizes, run_collections
+import metrics
+import rate_limit
 
 def json_convert(content):
 
@@ -131,119 +129,462 @@ def json_convert(content):
 
     return new_json
 
-def update_catalog(app_host, csc_catalog_client):
+def convert_item(item, collection, raster_metadata=None):
 
     """
-    The main updating function of the script. Checks the collection items in the FMI catalog and compares the to the ones in CSC catalog.
+    Converts a pystac Item of the FMI catalog into a GeoServer product.
 
-    app_host - The REST API path for updating the collections
-    csc_catalog_client - The STAC API path for checking which items are already in the collections
+    item - pystac Item, changed in place
+    collection - The FMI collection the item belongs to
+    raster_metadata - gsd, proj:epsg and proj:transform read from the raster header
     """
-    
-    session = requests.Session()
-    session.auth = ("admin", pwd)
-    log_headers = {"User-Agent": "update-script"} # Added for easy log-filtering
 
-    # Get all FMI collections from the app_host
-    csc_collections = [col for col in csc_catalog_client.get_collections() if col.id.endswith("at_fmi")]
+    item.extra_fields.update(raster_metadata or {})
 
-    for collection in csc_collections:
+    # Only the collection id is set, the collection does not keep a reference to the item
+    item.set_collection(collection)
 
-        derived_from = [link.target for link in collection.links if link.rel == "derived_from"]
+    for asset in item.assets:
+        if item.assets[asset].roles is not list:
+            item.assets[asset].roles = [item.assets[asset].roles]
 
-        # Some collections have wrongly configured Temporal Extents
-        try:
-            fmi_collection = Collection.from_file(derived_from[0])
-        except ValueError:
-            with urllib.request.urlopen(derived_from[0]) as url:
-                data = json.load(url)
-                data["extent"]["temporal"]["interval"] = [data["extent"]["temporal"]["interval"]]
-                fmi_collection = Collection.from_dict(data)
+    del item.extra_fields["license"]
+    item.remove_links("license")
 
-        fmi_collection.id = collection.id
-        print(f"# Checking collection {collection.id}:")
-        fmi_collection_links = fmi_collection.get_child_links()
+    return json_convert(item.to_dict())
 
-        sub_collections = []
-        for link in fmi_collection_links:
+def convert_item_dict(content, collection_id, raster_metadata=None):
 
-            # Some collections have wrongly configured Temporal Extents
-            try:
-                sub_collections.append(Collection.from_file(link.target))
-            except ValueError:
-                with urllib.request.urlopen(link.target) as url:
-                    data = json.load(url)
-                    data["extent"]["temporal"]["interval"] = [data["extent"]["temporal"]["interval"]]
-                    sub_collections.append(Collection.from_dict(data))
-
-        item_links = list(set([link.target for sub in sub_collections for link in sub.get_item_links()]))
-        csc_item_ids = [x.id for x in collection.get_items()]
-
-        items = []
-        errors = []
-        for item in item_links:
-            try:
-                items.append(Item.from_file(item))
-            except Exception as e:
-                print(f" ! {e} on {item}")
-                errors.append(item)
-
-        # If there were connection errors during the item making process, the item generation for errors is retried
-        if len(errors) > 0:
-            retry_errors(items, errors)
-            print(" * All errors fixed")
-        
-        print(f" * Number of items in CSC STAC and FMI: {len(csc_item_ids)}/{len(items)}")
-
-        for item in items:
-            if item.id not in csc_item_ids:
-                fmi_collection.add_item(item)
-
-                with rasterio.open(next(iter(item.assets.values())).href) as src:
-                    item.extra_fields["gsd"] = src.res[0]
-                    # 9391 EPSG code is false, replace by the standard 3067
-                    if src.crs.to_epsg() == 9391:
-                        item.extra_fields["proj:epsg"] = 3067
-                    else:
-                        item.extra_fields["proj:epsg"] = src.crs.to_epsg()
-                    item.extra_fields["proj:transform"] = [
-                        src.transform.a,
-                        src.transform.b,
-                        src.transform.c,
-                        src.transform.d,
-                        src.transform.e,
-                        src.transform.f,
-                        src.transform.g,
-                        src.transform.h,
-                        src.transform.i
-                    ]
+    """
+    Converts the raw JSON dictionary of an FMI item into a GeoServer product without making a pystac Item.
+    Makes the same changes to the dictionary as convert_item makes to the Item, see check_conversion for comparing the two.
 
-                for asset in item.assets:
-                    if item.assets[asset].roles is not list:
-                        item.assets[asset].roles = [item.assets[asset].roles]
-    
-                del item.extra_fields["license"]
-                item.remove_links("license")
+    content - Item dictionary as read from the FMI catalog, changed in place
+    collection_id - Id of the collection the item belongs to
+    raster_metadata - gsd, proj:epsg and proj:transform read from the raster header
+    """
+
+    content.update(raster_metadata or {})
+    content["collection"] = collection_id
+
+    # pystac writes the datetime in its own format
+    if content["properties"].get("datetime") is not None:
+        content["properties"]["datetime"] = datetime_to_str(str_to_datetime(content["properties"]["datetime"]))
+
+    for asset in content["assets"].values():
+        # pystac leaves out empty asset fields
+        for key in ("type", "title", "description"):
+            if key in asset and asset[key] is None:
+                del asset[key]
+        asset["roles"] = [asset.get("roles")]
+
+    del content["license"]
+
+    return json_convert(content)
+
+def check_conversion(content, collection, raster_metadata=None):
+
+    """
+    Converts an item both with convert_item_dict and with convert_item and returns the paths of the fields where the
+    products differ, an empty list if they are the same.
+
+    content - Item dictionary as read from the FMI catalog
+    collection - The FMI collection the item belongs to
+    """
+
+    item = Item.from_dict(copy.deepcopy(content), migrate=True, preserve_dict=False)
+    expected = convert_item(item, collection, raster_metadata)
+    converted = convert_item_dict(copy.deepcopy(content), collection.id, raster_metadata)
 
-                item_dict = item.to_dict()
-                converted_item = json_convert(item_dict)
-                request_point = f"collections/{collection.id}/products"
-                r = session.post(urljoin(app_host, request_point), headers=log_headers, json=converted_item)
-                r.raise_for_status()
+    def differences(a, b, path):
+        if isinstance(a, dict) and isinstance(b, dict):
+            return [
+                difference
+                for key in sorted(set(a) | set(b))
+                for difference in differences(a.get(key, KeyError), b.get(key, KeyError), f"{path}/{key}")
+            ]
+        return [] if a == b else [path]
 
-                print(f" + Added item {item.id}")
+    return differences(expected, converted, "")
 
-        print(f" * All items present")
+def sync_collection(collection, app_host, auth, csc_catalog_client, manifest_dir, workers=DEFAULT_WORKERS, raster_cache=None, page_size=DEFAULT_PAGE_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS, probe_workers=DEFAULT_WORKERS, retrier=None, checkpoint=None, direct=False, check_direct=0, db_dsn=None, batch_size=DEFAULT_BATCH_SIZE, max_delete_percent=DEFAULT_MAX_DELETE_PERCENT, use_async=False, http2=False):
 
-        # Update the extents from the FMI collection
-        collection.extent = fmi_collection.extent
-        collection_dict = collection.to_dict()
-        converted_collection = json_convert(collection_dict)
-        request_point = f"collections/{collection.id}/"
+    """
+    Syncs the items of one collection from the FMI catalog to the CSC catalog. Runs on its own, so it can be run in a worker process.
+    Returns the converted collection with the extent of the FMI collection and the number of items in FMI,
+    or None if the FMI collection could not be read.
+
+    collection - The collection in the CSC catalog
+    auth - Credentials of the REST API
+    direct - Convert the raw item dictionaries with convert_item_dict instead of making pystac Items
+    check_direct - In direct mode, number of items that are also converted with pystac and compared
+    db_dsn - Connection string of the OSEO database. If given, the products are written to the database in batches
+    batch_size - Number of products per database transaction
+    max_delete_percent - Products whose item is gone from FMI are deleted, unless that is more than this share of the collection
+    use_async - Fetch the sub-collections and items and write the products from one asyncio event loop thread,
+                the raster reads run in a pool of probe_workers threads
+    http2 - In the async mode, use HTTP/2 where the servers support it
+    The other arguments are described in update_catalog
+    """
+
+    retrier = retrier or Retrier()
+    derived_from = [link.target for link in collection.links if link.rel == "derived_from"]
+
+    try:
+        with metrics.timer("collection"):
+            fmi_collection = retrier.call("collection", derived_from[0], load_collection, derived_from[0])
+    except Exception as e:
+        print(f" ! Skipping collection {collection.id}: {e}")
+        return None
 
-        r = session.put(urljoin(app_host, request_point), headers=log_headers, json=converted_collection)
-        r.raise_for_status()
-        print(f" * Updated collection")
+    fmi_collection.id = collection.id
+    print(f"# Checking collection {collection.id}:")
+
+    log_headers = {"User-Agent": "update-script"} # Added for easy log-filtering
+    if use_async:
+        # Async mode: the requests are coroutines on one event loop thread, shared by the fetches and the writes
+        loop_thread = EventLoopThread()
+        writer = AsyncGeoServerWriter(app_host, auth, headers=log_headers, workers=upload_workers, on_result=print_write_result, retrier=retrier, http2=http2, loop_thread=loop_thread)
+    else:
+        loop_thread = None
+        writer = GeoServerWriter(app_host, auth, headers=log_headers, workers=upload_workers, on_result=print_write_result, retrier=retrier)
+    try:
+        if db_dsn:
+            # Bulk mode: the products go straight to the OSEO database, batch_size products per transaction
+            writer = BulkProductWriter(writer, ProductDatabase(db_dsn), batch_size=batch_size, on_result=print_write_result, retrier=retrier)
+
+        csc_item_ids = list_item_ids(csc_catalog_client, collection.id, page_size=page_size)
+        manifest = SyncManifest.load(Path(manifest_dir) / f"{collection.id}.json")
+
+        # Writes of the interrupted run are applied to the manifest, so they are not made again
+        if checkpoint:
+            journaled = checkpoint.entries(collection.id, "upload")
+            for item_id, write in journaled.items():
+                if write["method"] == "DELETE":
+                    manifest.remove(item_id)
+                else:
+                    manifest.record(item_id, write["source"], write["converted"])
+            if journaled:
+                print(f" * Resuming after {len(journaled)} product writes")
+
+        plan = SyncPlan()
+        source_hashes = {}
+        # Links of sub-collections or items that could not be read even after retrying
+        skipped = []
+        lock = threading.Lock()
+
+        def load_sub_collection(href):
+            with metrics.timer("child"):
+                return retrier.call("collection", href, load_collection, href)
+
+        stac_io = StacIO.default()
+        # Number of items converted in direct mode, the first check_direct of them are compared to the pystac conversion
+        checked = [0]
+
+        def fetch(link):
+            try:
+                if direct:
+                    # The raw item dictionary is used as it is, no pystac Item is made
+                    item = retrier.call("item", link, stac_io.read_json, link)
+                else:
+                    item = retrier.call("item", link, Item.from_file, link)
+            except Exception:
+                skipped.append(link)
+                return None
+            return plan_item(item)
+
+        def plan_item(item):
+            # Hash the FMI item as it is and compare it to the manifest of the last successful sync
+            item_id = item["id"] if direct else item.id
+            source_hash = content_hash(item if direct else item.to_dict())
+            with lock:
+                source_hashes[item_id] = source_hash
+                action = plan.classify(item_id, source_hash, manifest, csc_item_ids)
+            # Only added and changed items need the raster read and the conversion
+            return item if action != "unchanged" else None
+
+        def probe(item):
+            # gsd, proj:epsg and proj:transform are read from the raster header
+            href = next(iter(item["assets"].values()))["href"] if direct else item_raster_href(item)
+            return item, retrier.call("raster", href, cached_raster_metadata, href, raster_cache)
+
+        def convert(probed):
+            item, raster_metadata = probed
+            if direct:
+                item_id = item["id"]
+                with lock:
+                    check = checked[0] < check_direct
+                    checked[0] += 1
+                if check:
+                    differences = check_conversion(item, fmi_collection, raster_metadata)
+                    if differences:
+                        print(f" ! Direct conversion of {item_id} differs from the pystac conversion in {', '.join(differences)}")
+                converted_item = convert_item_dict(item, collection.id, raster_metadata)
+            else:
+                item_id = item.id
+                converted_item = convert_item(item, fmi_collection, raster_metadata)
+            converted_hash = content_hash(converted_item)
+
+            with lock:
+                if item_id in plan.add:
+                    method = "POST"
+                elif plan.resolve(item_id, converted_hash, manifest):
+                    method = "PUT"
+                else:
+                    manifest.record(item_id, source_hashes[item_id], converted_hash)
+                    return None
+            return method, item_id, converted_item, converted_hash
+
+        written_hashes = {}
+
+        def journal(future, source_hash=None, converted_hash=None):
+            result = future.result()
+            if checkpoint and result.ok:
+                checkpoint.mark(collection.id, "upload", result.key, {"method": result.method, "source": source_hash, "converted": converted_hash})
+
+        def upload(write):
+            method, item_id, converted_item, converted_hash = write
+            written_hashes[item_id] = converted_hash
+            if method == "POST":
+                future = writer.post_product(collection.id, converted_item, key=item_id)
+            else:
+                future = writer.put_product(collection.id, item_id, converted_item, key=item_id)
+            future.add_done_callback(lambda future: journal(future, source_hashes[item_id], converted_hash))
+
+        async def sync_items_async():
+            # The same stages as the pipeline below, as coroutines: tens of thousands of small JSON requests are
+            # multiplexed on the event loop thread and only the raster reads need threads
+            fetcher = AsyncFetcher.from_client(getattr(stac_io, "client", None), http2=http2, connections=workers)
+            probe_executor = ThreadPoolExecutor(max_workers=probe_workers)
+            loop = asyncio.get_running_loop()
+            child_fetches = asyncio.Semaphore(workers)
+            item_fetches = asyncio.Semaphore(workers)
+            # Bounds the number of items between the link discovery and the queued upload, like the queues of the pipeline.
+            # A slot is taken before the task of an item is created and given back once its product is queued
+            processing = asyncio.Semaphore(DEFAULT_QUEUE_SIZE)
+            seen = set()
+            children = []
+            tasks = []
+
+            async def fetch_item(link):
+                content = await fetcher.get_json(link)
+                # The raw item dictionary in direct mode, else made the way Item.from_file makes it
+                return content if direct else Item.from_dict(content, href=link, migrate=True, preserve_dict=False)
+
+            async def sync_item(link):
+                try:
+                    try:
+                        async with item_fetches:
+                            with metrics.timer("fetch"):
+                                item = plan_item(await retrier.call_async("item", link, fetch_item, link))
+                    except Exception:
+                        skipped.append(link)
+                        return
+                    if item is None:
+                        return
+                    stage = "probe"
+                    try:
+                        with metrics.timer("probe"):
+                            probed = await loop.run_in_executor(probe_executor, probe, item)
+                        stage = "convert"
+                        with metrics.timer("convert"):
+                            write = convert(probed)
+                    except Exception as e:
+                        print(f" ! {stage} failed on {getattr(item, 'id', item)}: {e}")
+                        return
+                    if write:
+                        # Waits while the maximum number of writes or database batches is queued, so products do not pile up
+                        # when GeoServer or the database is slower than the sync
+                        await writer.ready()
+                        upload(write)
+                finally:
+                    processing.release()
+
+            async def load_child(href):
+                try:
+                    async with child_fetches:
+                        with metrics.timer("child"):
+                            sub_collection = await retrier.call_async("collection", href, fetcher.get_json, href)
+                except Exception:
+                    skipped.append(href)
+                    return
+                for link in raw_item_links(sub_collection, href):
+                    if link not in seen:
+                        seen.add(link)
+                        await processing.acquire()
+                        tasks.append(asyncio.create_task(sync_item(link)))
+
+            try:
+                children.extend(asyncio.create_task(load_child(link.target)) for link in fmi_collection.get_child_links())
+                await asyncio.gather(*children)
+                await asyncio.gather(*tasks)
+            finally:
+                # After a failure the remaining tasks are cancelled, so none of them uses the fetcher or the executor once they are closed
+                for task in children + tasks:
+                    task.cancel()
+                await asyncio.gather(*children, *tasks, return_exceptions=True)
+                await fetcher.close()
+                probe_executor.shutdown(wait=False)
+
+        # link discovery -> item fetch -> raster probe -> conversion -> upload, all running at the same time
+        pipeline = Pipeline([
+            Stage("fetch", fetch, workers=workers),
+            Stage("probe", probe, workers=probe_workers),
+            Stage("convert", convert, workers=1),
+        ], on_error=lambda stage, value, e: print(f" ! {stage} failed on {getattr(value, 'id', value)}: {e}"))
+        if use_async:
+            loop_thread.run(sync_items_async())
+        else:
+            # Sub-collections are loaded concurrently and their item links are passed on as soon as each one has been loaded
+            item_links = discover_item_links(
+                [link.target for link in fmi_collection.get_child_links()],
+                load_sub_collection,
+                workers=workers,
+                on_error=lambda href, e: skipped.append(href)
+            )
+            pipeline.run(item_links, sink=upload)
+
+        print(f" * Number of items in CSC STAC and FMI: {len(csc_item_ids)}/{len(source_hashes)}")
+
+        # Items that could not be read are not known to be gone from FMI, so nothing is deleted
+        if skipped:
+            print(f" ! {len(skipped)} sub-collections or items could not be read, no items are deleted from {collection.id}")
+        else:
+            plan.finish(source_hashes, manifest, csc_item_ids)
+            deletes = len(plan.delete)
+            if not plan.check_deletes(csc_item_ids, max_delete_percent):
+                print(f" ! {deletes} of {len(csc_item_ids)} products would be deleted from {collection.id}, more than {max_delete_percent}%. No items are deleted")
+        print(f" * Sync plan: {plan.summary()}")
+
+        for item_id in plan.delete:
+            writer.delete_product(collection.id, item_id, key=item_id).add_done_callback(journal)
+
+        # Only successful writes go into the manifest, failed ones are tried again on the next run
+        failed = set()
+        for result in writer.drain():
+            if not result.ok:
+                failed.add(result.key)
+            elif result.method == "DELETE":
+                manifest.remove(result.key)
+            else:
+                manifest.record(result.key, source_hashes[result.key], written_hashes[result.key])
+
+        if not skipped:
+            for item_id in list(manifest.entries):
+                if item_id not in source_hashes and item_id not in failed:
+                    manifest.remove(item_id)
+        for item_id in plan.unchanged:
+            manifest.record(item_id, source_hashes[item_id], manifest.converted_hash(item_id))
+
+        if failed:
+            print(f" ! {len(failed)} product writes failed in {collection.id}")
+        else:
+            print(f" * All items present")
+    finally:
+        # Also after a failure, so no threads, sessions or event loops are left behind
+        writer.close()
+        if loop_thread:
+            loop_thread.close()
+
+    # The manifest is only written once all items of the collection have been synced
+    manifest.save()
+
+    # Update the extents from the FMI collection, the collection itself is written once all collections are done
+    collection.extent = fmi_collection.extent
+    collection_dict = collection.to_dict()
+    return json_convert(collection_dict), len(source_hashes)
+
+
+def update_catalog(app_host, csc_catalog_client, manifest_dir, workers=DEFAULT_WORKERS, raster_cache=None, page_size=DEFAULT_PAGE_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS, probe_workers=DEFAULT_WORKERS, retrier=None, checkpoint=None, processes=1, sizes=None, fmi_client=None, direct=False, check_direct=0, db_dsn=None, batch_size=DEFAULT_BATCH_SIZE, max_delete_percent=DEFAULT_MAX_DELETE_PERCENT, profile=None, use_async=False, http2=False):
+
+    """
+    The main updating function of the script. Checks the collection items in the FMI catalog and compares the to the ones in CSC catalog.
+
+    app_host - The REST API path for updating the collections
+    csc_catalog_client - The STAC API path for checking which items are already in the collections
+    manifest_dir - Directory of the sync manifests that record the item hashes of the last successful sync
+    workers - Number of concurrent item requests to the FMI catalog
+    raster_cache - Optional RasterMetadataCache so that unchanged rasters are not opened again
+    page_size - Page size used when listing the item ids in the CSC catalog
+    upload_workers - Number of product writes in flight to GeoServer at the same time
+    probe_workers - Number of raster headers read at the same time
+    retrier - Retrier for all network calls. Calls that keep failing are skipped and reported as dead letters
+    checkpoint - Optional Checkpoint journal of the synced collections and product writes, used to resume an interrupted run
+    processes - Number of collections synced at the same time in worker processes
+    sizes - Optional CollectionSizes, the largest collections of the previous run are started first
+    fmi_client - CachedHttpClient that the worker processes read the FMI catalog through
+    direct - Convert the items from their raw dictionaries without making pystac Items
+    check_direct - In direct mode, number of items per collection that are also converted with pystac and compared
+    db_dsn - Connection string of the OSEO database for the bulk mode, the products are written to it in batches of batch_size
+    max_delete_percent - Largest share of the products of a collection that is deleted because their items are gone from FMI
+    profile - Optional (collection id, directory): the sync of this collection is profiled and the profile is written to directory
+    use_async - Fetch the FMI JSON and write the products from an asyncio event loop instead of pools of threads
+    http2 - In the async mode, use HTTP/2 where the servers support it
+    """
+    
+    retrier = retrier or Retrier()
+
+    # Get all FMI collections from the app_host
+    csc_collections = [col for col in csc_catalog_client.get_collections() if col.id.endswith("at_fmi")]
+
+    jobs = {}
+    for collection in csc_collections:
+        if checkpoint and checkpoint.done(collection.id, "collection", "synced"):
+            print(f"# Collection {collection.id} was synced by the previous run, skipping it")
+            continue
+        jobs[collection.id] = (collection,)
+
+    results = run_collections(
+        sync_collection,
+        jobs,
+        processes=processes,
+        sizes=sizes,
+        retrier=retrier,
+        fmi_client=fmi_client,
+        profile=(profile[0], profile[1], f"update_fmi_{profile[0]}") if profile else None,
+        app_host=app_host,
+        auth=("admin", pwd),
+        csc_catalog_client=csc_catalog_client,
+        manifest_dir=manifest_dir,
+        workers=workers,
+        raster_cache=raster_cache,
+        page_size=page_size,
+        upload_workers=upload_workers,
+        probe_workers=probe_workers,
+        checkpoint=checkpoint,
+        direct=direct,
+        check_direct=check_direct,
+        db_dsn=db_dsn,
+        batch_size=batch_size,
+        max_delete_percent=max_delete_percent,
+        use_async=use_async,
+        http2=http2
+    )
+
+    # The collections are updated once the items of every collection have been synced
+    log_headers = {"User-Agent": "update-script"} # Added for easy log-filtering
+    writer = GeoServerWriter(app_host, ("admin", pwd), headers=log_headers, retrier=retrier)
+    for collection_id, result in results.items():
+        if result is None or isinstance(result, Exception):
+            continue
+        converted_collection, item_count = result
+        if sizes:
+            sizes.update(collection_id, item_count)
+
+        request_point = f"collections/{collection_id}/"
+        try:
+            writer.request("PUT", request_point, json=converted_collection)
+        except Exception as e:
+            print(f" ! Updating collection {collection_id} failed: {e}")
+            continue
+        print(f" * Updated collection {collection_id}")
+
+        if checkpoint:
+            checkpoint.mark(collection_id, "collection", "synced")
+
+    writer.close()
+    if sizes:
+        sizes.save()
     
 if __name__ == "__main__":
 
@@ -254,6 +595,31 @@ if __name__ == "__main__":
     pw_filename = 'passwords.txt'
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of concurrent item requests to the FMI catalog")
+    parser.add_argument("--probe-workers", type=int, default=DEFAULT_WORKERS, help="Number of concurrent raster header reads")
+    parser.add_argument("--cache-dir", type=Path, default=DEFAULT_CACHE_DIR, help="Directory for the local caches")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the local caches")
+    parser.add_argument("--upload-workers", type=int, default=DEFAULT_UPLOAD_WORKERS, help="Number of concurrent product writes to GeoServer")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Maximum attempts of a network call that fails with a timeout or a server error")
+    parser.add_argument("--retry-budget", type=int, default=DEFAULT_RETRY_BUDGET, help="Maximum number of retries in the whole run")
+    parser.add_argument("--dead-letters", type=Path, default=Path("dead_letters.json"), help="File for the report of skipped items")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from where it stopped")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="Page size when listing the item ids in the CSC STAC API")
+    parser.add_argument("--direct", action="store_true", help="Convert the items from their raw JSON without making pystac Items")
+    parser.add_argument("--check-direct", type=int, default=0, help="With --direct, number of items per collection that are also converted with pystac and compared")
+    parser.add_argument("--db", type=str, default=None, help="Connection string of the OSEO database. Writes the products straight to the database in batches")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of products per database transaction with --db")
+    parser.add_argument("--max-delete-percent", type=float, default=DEFAULT_MAX_DELETE_PERCENT, help="Do not delete anything from a collection if more than this percentage of its products would be deleted")
+    parser.add_argument("--processes", type=int, default=1, help="Number of collections synced at the same time in separate processes")
+    parser.add_argument("--metrics", type=Path, default=None, help="JSON file for the run report with the timings and counters of each stage")
+    parser.add_argument("--prometheus", type=Path, default=None, help="File for the metrics of the run in the Prometheus text format")
+    parser.add_argument("--profile", type=str, default=None, help="Id of a collection whose run is profiled with cProfile, tracemalloc and stack sampling. The profile is written next to the --metrics report, or into the profile folder")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Fetch the FMI JSON and write the products from one asyncio event loop, needs httpx")
+    parser.add_argument("--http2", action="store_true", help="With --async, use HTTP/2 where the servers support it, needs httpx[http2]")
+    parser.add_argument("--adaptive", action="store_true", help="Adapt the number of concurrent requests to each host to its latency and errors")
+    parser.add_argument("--host-limit", nargs="+", default=[], help="Starting concurrency of a host as host=N, e.g. pta.data.lit.fmi.fi=8. Implies --adaptive")
+    parser.add_argument("--host-rate", nargs="+", default=[], help="Maximum requests per second to a host as host=R. Implies --adaptive")
+    parser.add_argument("--latency-target", type=float, default=None, help="With --adaptive, responses slower than this many seconds also lower the concurrency of the host")
     
     args = parser.parse_args()
 
@@ -269,7 +635,35 @@ if __name__ == "__main__":
     csc_catalog_client = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
 
     print(f"Updating STAC Catalog at {args.host}")
-    update_catalog(app_host, csc_catalog_client)
+    raster_cache = None if args.no_cache else RasterMetadataCache(args.cache_dir / "raster_metadata.sqlite")
+
+    # FMI catalog JSON is read through a local cache and only downloaded again when it has changed
+    fmi_client = http_cache.CachedHttpClient(
+        None if args.no_cache else http_cache.HttpCache(args.cache_dir / "http.sqlite"),
+        headers={"User-Agent": "update-script"}
+    )
+    http_cache.install(fmi_client)
+
+    retrier = Retrier(default_policies(args.max_attempts), budget=args.retry_budget)
+
+    # Concurrency and rate limits per host for the catalog fetches, raster reads and GeoServer writes
+    rate_limit.install(rate_limit.from_args(args.adaptive, args.host_limit, args.host_rate, args.latency_target))
+
+    # Journal of the synced collections and product writes
+    checkpoint = Checkpoint(args.cache_dir / "checkpoint_update_fmi.sqlite", resume=args.resume)
+
+    # Item counts of the previous run, so that the largest collections are started first
+    sizes = CollectionSizes(args.cache_dir / "collection_sizes_update.json")
+
+    profile = (args.profile, args.metrics.parent if args.metrics else Path("profile")) if args.profile else None
+
+    update_catalog(app_host, csc_catalog_client, args.cache_dir / "sync", workers=args.workers, raster_cache=raster_cache, page_size=args.page_size, upload_workers=args.upload_workers, probe_workers=args.probe_workers, retrier=retrier, checkpoint=checkpoint, processes=args.processes, sizes=sizes, fmi_client=fmi_client, direct=args.direct, check_direct=args.check_direct, db_dsn=args.db, batch_size=args.batch_size, max_delete_percent=args.max_delete_percent, profile=profile, use_async=args.use_async, http2=args.http2)
+    retrier.report(args.dead_letters)
+    print(f"FMI catalog requests: {fmi_client.summary()}")
+    print(metrics.METRICS.summary())
+    if rate_limit.LIMITERS:
+        print(rate_limit.LIMITERS.summary())
+    metrics.METRICS.save(args.metrics, args.prometheus, script="update_fmi", retries=retrier.retries, dead_letters=len(retrier.dead_letters))
 
     end = time.time()
     print(f"Script took {end-start:.2f} seconds")
\ No newline at end of file